@@ -1,17 +1,25 @@
 import sys
 import os
 import csv
-import cv2
+import multiprocessing
+from functools import partial
 import pydicom.errors
-from pydicom import dcmread
 from pathlib import Path
 from skimage.morphology import reconstruction
 
 from PyQt6.QtWidgets import QWidget, QTableWidgetItem, QSlider, QLabel, QGridLayout, QHBoxLayout, QFileDialog, QMainWindow, QGraphicsView, QProgressBar, QMessageBox
-from PyQt6.QtGui import QImage, QPixmap, QPainter, QActionGroup, QKeySequence, QColor
+from PyQt6.QtGui import QImage, QPixmap, QActionGroup, QKeySequence, QColor
 
 from gui_utils.custom_widgets import *
-from gui_utils.segmentation_utils import segmentation
+from gui_utils.segmentation_utils import ModelRegistry, SegmentationWorker
+from gui_utils.dicom_utils import DICOMLoader, LazyVolume, find_dicoms
+from gui_utils.cache_utils import VolumeCache
+from gui_utils.save_utils import AnnotationSaver
+from gui_utils.prefetch_utils import ExamPrefetcher
+from gui_utils.annotation_utils import annotation_manifest, annotation_writers, read_study_masks
+from gui_utils.mask_utils import MaskVolume, overlay_lut, compose_overlay
+from gui_utils.volume_utils import VolumeView
+from gui_utils.render_utils import RenderScheduler, PixmapCache, SlicePrerenderer, slice_image, slice_overlay
 from gui_utils.image_utils import *
 from gui_utils.drawing_utils import *
 
@@ -32,6 +40,11 @@ class DLLabelsCT(QMainWindow):
         self.pixelSpacingX = {}
         self.pixelSpacingY = {}
         self.currentDICOMStack = None
+        self.examToken = 0
+        self.invertDICOMs = False
+        self.windowLUT = window_lut(self.dicomWindowCenter, self.dicomWindowWidth)
+        self.axialLUT = self.windowLUT
+        self.axialLUTSettings = (0, 1.0)
         self.currentMaskStack = {}
         self.maskColors = {}
         self.hiddenLabels = []
@@ -51,12 +64,27 @@ class DLLabelsCT(QMainWindow):
         self.showMasks = True
         self.saveImages = True
         self.saveFlipped = True
+        self.saveFormat = "npz"
+        self.pngCompression = 1
         self.removeOutliers = False
         self.fillContours = False
         self.useFileOrder = False
+        self.useProcesses = False
+        self.useVolumeCache = True
+        self.volumeCacheDirectory = Path.home() / ".dllabelsct" / "volume_cache"
+        self.volumeCacheSize = 20
+        self.usePrefetch = True
+        self.prefetchMemory = 4
+        self.lazyVolumeSize = 1
+        self.lazyReservation = None
+        self.pixmapCacheSize = 256
+        self.prerenderSlices = 4
         self.device = "cuda"
-        self.flip = {"Axial": False, "Coronal": False, "Sagittal": False}
+        self.volumeView = None
+        self.savedExam = None
         self.axialImageQt = None
+        self.renderedIndex = {"axial": None, "coronal": None, "sagittal": None}
+        self.travelDirection = {"axial": 1, "coronal": 1, "sagittal": 1}
 
         self.clickType = {"Selecting": True, "Dragging": False, "Drawing": False, "Erasing": False, "Measuring": False}
         self.erasingOrDrawing = 1
@@ -66,12 +94,32 @@ class DLLabelsCT(QMainWindow):
         self.drawnMaskType = None
 
         self.segmentationModelType = None
+        self.segmentationBatchSize = None
+        self.modelCacheSize = 2
+        self.segmentationWorker = None
+        self.segmentationTargets = {}
+        self.segmentationError = None
+        self.segmentationView = None
+        self.segmentationCancelled = False
 
         self.maskOpacity = 128
 
         self.brightness = 0
         self.contrast = 1.0
 
+        self.dicomLoader = DICOMLoader(use_processes=self.useProcesses, parent=self)
+        self.volumeCache = VolumeCache(self.volumeCacheDirectory, self.volumeCacheSize * 1024**3)
+        self.sliceIO = annotation_writers["png"].slice_io
+        self.annotationSaver = AnnotationSaver(parent=self)
+        self.annotationSaver.progress.connect(self.showSaveProgress)
+        self.annotationSaver.finished.connect(self.saveFinished)
+        self.annotationSaver.failed.connect(self.saveFailed)
+        self.examPrefetcher = ExamPrefetcher(self.volumeCache, self.prefetchMemory * 1024**3, annotation_saver=self.annotationSaver)
+        self.renderScheduler = RenderScheduler(self.updateSingleImage, parent=self)
+        self.pixmapCache = PixmapCache(self.pixmapCacheSize * 1024**2)
+        self.slicePrerenderer = SlicePrerenderer()
+        self.modelRegistry = ModelRegistry(self.modelCacheSize * 1024**3)
+
         centralWidget = QWidget(self)
         self.setCentralWidget(centralWidget)
         centralLayout = QHBoxLayout(centralWidget)
@@ -115,6 +163,8 @@ class DLLabelsCT(QMainWindow):
         loadMasksAct.triggered.connect(self.loadMasks)
         saveAnnotationsAct = QAction('Save annotations', self)
         saveAnnotationsAct.triggered.connect(self.saveAnnotations)
+        rebuildManifestAct = QAction('Rebuild annotation index', self)
+        rebuildManifestAct.triggered.connect(self.rebuildManifest)
         saveLabelsAct = QAction('Save labels...', self)
         saveLabelsAct.triggered.connect(self.saveLabels)
         loadLabelsAct = QAction('Load labels...', self)
@@ -128,6 +178,7 @@ class DLLabelsCT(QMainWindow):
         fileMenu.addAction(loadMasksAct)
         fileMenu.addSeparator()
         fileMenu.addAction(saveAnnotationsAct)
+        fileMenu.addAction(rebuildManifestAct)
         fileMenu.addSeparator()
         fileMenu.addAction(saveLabelsAct)
         fileMenu.addAction(loadLabelsAct)
@@ -197,7 +248,13 @@ class DLLabelsCT(QMainWindow):
         selectFillingAct = QAction('Automatically fill holes in masks', self, checkable=True)
         selectImageSavingAct = QAction('Save images when annotating', self, checkable=True)
         selectImageFlippingAct = QAction('Save flipped images when annotating', self, checkable=True)
+        savePNGAct = QAction('Save annotations as PNG slices', self, checkable=True)
         useFileOrderAct = QAction('Show DICOMs by filename order', self, checkable=True)
+        useProcessesAct = QAction('Decode DICOMs in separate processes', self, checkable=True)
+        useVolumeCacheAct = QAction('Cache opened exams on disk', self, checkable=True)
+        setVolumeCacheSizeAct = QAction('Set exam cache size...', self)
+        usePrefetchAct = QAction('Prefetch neighbouring exams when annotating', self, checkable=True)
+        setVolumeCacheSizeAct.triggered.connect(self.setVolumeCacheSize)
         self.agOptions = QActionGroup(self)
         showingDICOMPath = self.agOptions.addAction(selectDICOMPathShowingAct)
         showingSegmentationPath = self.agOptions.addAction(selectSegmentationPathShowingAct)
@@ -208,12 +265,18 @@ class DLLabelsCT(QMainWindow):
         savingImages = self.agOptions.addAction(selectImageSavingAct)
         savingFlipped = self.agOptions.addAction(selectImageFlippingAct)
         fileOrder = self.agOptions.addAction(useFileOrderAct)
+        useProcesses = self.agOptions.addAction(useProcessesAct)
+        useVolumeCache = self.agOptions.addAction(useVolumeCacheAct)
+        usePrefetch = self.agOptions.addAction(usePrefetchAct)
+        savingPNG = self.agOptions.addAction(savePNGAct)
         self.agOptions.setExclusive(False)
         savingImages.setChecked(True)
         savingFlipped.setChecked(True)
         showingDICOMPath.setChecked(True)
         showingSegmentationPath.setChecked(True)
         showingSaveFolderPath.setChecked(True)
+        useVolumeCache.setChecked(True)
+        usePrefetch.setChecked(True)
         optionsMenu.addAction(showingDICOMPath)
         optionsMenu.addAction(showingSegmentationPath)
         optionsMenu.addAction(showingSaveFolderPath)
@@ -224,8 +287,13 @@ class DLLabelsCT(QMainWindow):
         optionsMenu.addSeparator()
         optionsMenu.addAction(savingImages)
         optionsMenu.addAction(savingFlipped)
+        optionsMenu.addAction(savingPNG)
         optionsMenu.addSeparator()
         optionsMenu.addAction(fileOrder)
+        optionsMenu.addAction(useProcesses)
+        optionsMenu.addAction(useVolumeCache)
+        optionsMenu.addAction(setVolumeCacheSizeAct)
+        optionsMenu.addAction(usePrefetch)
         self.agOptions.triggered.connect(self.changeOptions)
 
         drawingMenu = menubar.addMenu('Drawing options')
@@ -434,10 +502,22 @@ class DLLabelsCT(QMainWindow):
 
         self.statusbar = self.statusBar()
 
+    def closeEvent(self, event):
+
+        self.dicomLoader.shutdown()
+        self.examPrefetcher.shutdown()
+        self.slicePrerenderer.shutdown()
+        self.cancelSegmentation(wait=True)
+        self.annotationSaver.shutdown()
+        self.releaseLazyVolume()
+        self.sliceIO.shutdown()
+        super().closeEvent(event)
+
     def _createProgressBar(self):
 
         self.progressBar = QProgressBar(self)
         self.progressBar.setRange(0, 100)
+        self.dicomLoader.progress.connect(self.progressBar.setValue)
         self.gridLayout.addWidget(self.progressBar, 8, 0, 1, 3)
         self.progressBar.hide()
 
@@ -446,17 +526,17 @@ class DLLabelsCT(QMainWindow):
         self.brightness = 0
         self.contrast = 1
         self.axialDICOMIndex = sliderValue
-        self.updateSingleImage(imageType="axial")
+        self.renderScheduler.schedule("axial")
 
     def changeCoronalImageIndex(self, sliderValue):
 
         self.coronalDICOMIndex = sliderValue
-        self.updateSingleImage(imageType="coronal")
+        self.renderScheduler.schedule("coronal")
 
     def changeSagittalImageIndex(self, sliderValue):
 
         self.sagittalDICOMIndex = sliderValue
-        self.updateSingleImage(imageType="sagittal")
+        self.renderScheduler.schedule("sagittal")
 
     def changeOpacity(self, sliderValue):
 
@@ -505,10 +585,8 @@ class DLLabelsCT(QMainWindow):
                         self.agWindowing.actions()[0].setChecked(True)
                         self.dicomWindowCenter = 50
                         self.dicomWindowWidth = 400
-            self.currentDICOMStack = None
-            self.showImages(imagesChanged=False)
-            if self.showMasks:
-                self.updateImages()
+            self.applyWindowing()
+            self.updateImages()
         else:
             self.agWindowing.actions()[0].setChecked(True)
             self.dicomWindowCenter = 50
@@ -521,6 +599,8 @@ class DLLabelsCT(QMainWindow):
             self.device = "cuda"
         elif act.text() == "CPU":
             self.device = "cpu"
+        # Models loaded on the previous device are not used anymore
+        self.modelRegistry.clear()
 
     def changeOptions(self, act):
 
@@ -560,10 +640,42 @@ class DLLabelsCT(QMainWindow):
             self.useFileOrder = True
         else:
             self.useFileOrder = False
+        if self.agOptions.actions()[9].isChecked():
+            self.useProcesses = True
+        else:
+            self.useProcesses = False
+        self.dicomLoader.setUseProcesses(self.useProcesses)
+        if self.agOptions.actions()[10].isChecked():
+            self.useVolumeCache = True
+        else:
+            self.useVolumeCache = False
+        if self.agOptions.actions()[11].isChecked():
+            self.usePrefetch = True
+        else:
+            self.usePrefetch = False
+        if self.agOptions.actions()[12].isChecked():
+            self.saveFormat = "png"
+        else:
+            self.saveFormat = "npz"
+        self.prefetchNeighbours()
         if act.text() == 'Show DICOMs by filename order':
             self.currentDICOMStack = None
             self.showImages()
 
+    def setVolumeCacheSize(self):
+
+        cacheSizeDialog = CacheSizeDialog(parent=self)
+        if cacheSizeDialog.exec():
+            try:
+                cacheSize = int(cacheSizeDialog.setSizeValue.text())
+                if cacheSize < 0:
+                    raise ValueError
+            except ValueError:
+                self.statusbar.showMessage("Invalid cache size!")
+            else:
+                self.volumeCacheSize = cacheSize
+                self.volumeCache.setMaxBytes(cacheSize * 1024**3)
+
     def changeDrawingErasing(self, act):
 
         self.clickType = dict.fromkeys(self.clickType, False)
@@ -640,12 +752,10 @@ class DLLabelsCT(QMainWindow):
 
     def changeFlip(self, act):
 
-        if self.currentDICOMStack is None:
-            pass
-        else:
-            self.flip[act.text()] = True
+        # Only the orientation changes, the volume and masks are not rewritten
+        if self.currentDICOMStack is not None:
+            self.volumeView = VolumeView(self.currentDICOMStack.shape, [action.isChecked() for action in self.agFlip.actions()])
         self.updateImages()
-        self.flip = {"Axial": False, "Coronal": False, "Sagittal": False}
 
     def addLabel(self):
 
@@ -676,7 +786,7 @@ class DLLabelsCT(QMainWindow):
                     self.currentMaskStack[label] = None
                     self.axialImageScene.mask[label] = None
                 else:
-                    self.currentMaskStack[label] = np.zeros(self.currentDICOMStack.shape)
+                    self.currentMaskStack[label] = MaskVolume(self.currentDICOMStack.shape)
                     self.axialImageScene.createMask(label)
                 rowPosition = self.labelTable.rowCount()
                 self.modelClasses[label] = rowPosition
@@ -794,28 +904,11 @@ class DLLabelsCT(QMainWindow):
                 pass
             else:
                 self.currentPatientID = Path(self.DICOMFolderPath).name
-                self.dicoms = sorted(list(Path(self.DICOMFolderPath).rglob("*.dcm")))
-                if len(self.dicoms) > 1500 or len(self.dicoms) == 0:
-                    self.dicoms = sorted(list(Path(self.DICOMFolderPath).rglob("*")))
-                    if len(self.dicoms) > 1500 or len(self.dicoms) == 0:
-                        self.statusbar.showMessage("Invalid folder (too many DICOMs (> 1500) or no DICOMs found)")
-                    else:
-                        labelText = f"DICOM folder: {str(Path(self.DICOMFolderPath))}"
-                        self.currentDICOMPathLabel.setText(labelText)
-                        self.axialSlider.setRange(0, len(self.dicoms) - 1)
-                        self.currentDICOMStack = None
-                        self.currentMaskStack = reset_mask_stack(self.currentMaskStack)
-                        self.currentStudyID = None
-                        validFolder = self.showImages()
-                        if validFolder == 0:
-                            self.DICOMFolderPath = "None"
-                            labelText = f"DICOM folder: {str(Path(self.DICOMFolderPath))}"
-                            self.currentDICOMPathLabel.setText(labelText)
-                        self.annotableFolders = []
-                        self.annotableDirectory = None
-                        self.annotableIndex = 0
-                        self.selectExamAct.setVisible(False)
+                dicoms = find_dicoms(self.DICOMFolderPath)
+                if len(dicoms) == 0:
+                    self.statusbar.showMessage("Invalid folder (no DICOMs found)")
                 else:
+                    self.dicoms = dicoms
                     labelText = f"DICOM folder: {str(Path(self.DICOMFolderPath))}"
                     self.currentDICOMPathLabel.setText(labelText)
                     self.axialSlider.setRange(0, len(self.dicoms) - 1)
@@ -831,6 +924,7 @@ class DLLabelsCT(QMainWindow):
                     self.annotableDirectory = None
                     self.annotableIndex = 0
                     self.selectExamAct.setVisible(False)
+                    self.examPrefetcher.clear()
         QApplication.restoreOverrideCursor()
 
     def getSegmentationModelFolder(self):
@@ -897,31 +991,12 @@ class DLLabelsCT(QMainWindow):
                     self.annotableIndex = 0
                     self.DICOMFolderPath = Path(self.annotableDirectory) / self.annotableFolders[self.annotableIndex]
                     self.currentPatientID = Path(self.DICOMFolderPath).name
-                    self.dicoms = sorted(list(Path(self.DICOMFolderPath).rglob("*.dcm")))
-                    if len(self.dicoms) > 1500 or len(self.dicoms) == 0:
-                        self.dicoms = sorted(list(Path(self.DICOMFolderPath).rglob("*")))
-                        if len(self.dicoms) > 1500 or len(self.dicoms) == 0:
-                            self.statusbar.showMessage("Invalid folder (too many DICOMs (> 1500) or no DICOMs found)")
-                        else:
-                            labelText = f"DICOM folder: {str(Path(self.DICOMFolderPath))}"
-                            self.currentDICOMPathLabel.setText(labelText)
-                            self.axialSlider.setRange(0, len(self.dicoms) - 1)
-                            self.currentDICOMStack = None
-                            self.currentMaskStack = reset_mask_stack(self.currentMaskStack)
-                            self.currentStudyID = None
-                            validFolder = self.showImages()
-                            if validFolder == 0:
-                                self.DICOMFolderPath = "None"
-                                self.annotableDirectory = None
-                                self.annotableFolders = []
-                                labelText = f"DICOM folder: {str(Path(self.DICOMFolderPath))}"
-                                self.currentDICOMPathLabel.setText(labelText)
-                            elif self.saveDirectory is not None:
-                                self.loadAnnotations()
-                                self.selectExamAct.setVisible(True)
-                            else:
-                                self.selectExamAct.setVisible(True)
+                    self.examPrefetcher.clear()
+                    dicoms = find_dicoms(self.DICOMFolderPath)
+                    if len(dicoms) == 0:
+                        self.statusbar.showMessage("Invalid folder (no DICOMs found)")
                     else:
+                        self.dicoms = dicoms
                         labelText = f"DICOM folder: {str(Path(self.DICOMFolderPath))}"
                         self.currentDICOMPathLabel.setText(labelText)
                         self.axialSlider.setRange(0, len(self.dicoms) - 1)
@@ -938,8 +1013,10 @@ class DLLabelsCT(QMainWindow):
                         elif self.saveDirectory is not None:
                             self.loadAnnotations()
                             self.selectExamAct.setVisible(True)
+                            self.prefetchNeighbours()
                         else:
                             self.selectExamAct.setVisible(True)
+                            self.prefetchNeighbours()
         QApplication.restoreOverrideCursor()
 
     def changeAnnotable(self, save=True):
@@ -949,35 +1026,22 @@ class DLLabelsCT(QMainWindow):
             self.saveAnnotations()
         self.DICOMFolderPath = Path(self.annotableDirectory) / self.annotableFolders[self.annotableIndex]
         self.currentPatientID = Path(self.DICOMFolderPath).name
-        self.dicoms = sorted(list(Path(self.DICOMFolderPath).rglob("*.dcm")))
-        if len(self.dicoms) > 1500 or len(self.dicoms) == 0:
-            self.dicoms = sorted(list(Path(self.DICOMFolderPath).rglob("*")))
-            if len(self.dicoms) > 1500 or len(self.dicoms) == 0:
-                self.statusbar.showMessage("Invalid folder (too many DICOMs (> 1500) or no DICOMs found)")
-            else:
-                self.axialSlider.setRange(0, len(self.dicoms) - 1)
-                self.currentDICOMStack = None
-                self.currentMaskStack = reset_mask_stack(self.currentMaskStack)
-                self.currentStudyID = None
-                validFolder = self.showImages()
-                if validFolder == 0:
-                    self.annotableIndex += 1
-                    if self.annotableIndex >= len(self.annotableFolders):
-                        self.annotableIndex = 0
-                        self.statusbar.showMessage("Last annotable folder was invalid, switching to first folder")
-                    else:
-                        self.statusbar.showMessage("Invalid folder in annotables, switching to next folder")
-                    self.changeAnnotable(save=False)
-                else:
-                    self.loadAnnotations()
-                    labelText = f"DICOM folder: {str(Path(self.DICOMFolderPath))}"
-                    self.currentDICOMPathLabel.setText(labelText)
+        prefetched = None
+        if self.usePrefetch:
+            prefetched = self.examPrefetcher.take(self.DICOMFolderPath, self.prefetchContext())
+        if prefetched is not None:
+            dicoms = prefetched["dicoms"]
+        else:
+            dicoms = find_dicoms(self.DICOMFolderPath)
+        if len(dicoms) == 0:
+            self.statusbar.showMessage("Invalid folder (no DICOMs found)")
         else:
+            self.dicoms = dicoms
             self.axialSlider.setRange(0, len(self.dicoms) - 1)
             self.currentDICOMStack = None
             self.currentMaskStack = reset_mask_stack(self.currentMaskStack)
             self.currentStudyID = None
-            validFolder = self.showImages()
+            validFolder = self.showImages(prefetched=prefetched)
             if validFolder == 0:
                 self.annotableIndex += 1
                 if self.annotableIndex >= len(self.annotableFolders):
@@ -987,11 +1051,34 @@ class DLLabelsCT(QMainWindow):
                     self.statusbar.showMessage("Invalid folder in annotables, switching to next folder")
                 self.changeAnnotable(save=False)
             else:
-                self.loadAnnotations()
+                if prefetched is not None:
+                    self.loadAnnotations(prefetchedMasks=prefetched["masks"])
+                else:
+                    self.loadAnnotations()
                 labelText = f"DICOM folder: {str(Path(self.DICOMFolderPath))}"
                 self.currentDICOMPathLabel.setText(labelText)
+                self.prefetchNeighbours()
         QApplication.restoreOverrideCursor()
 
+    def prefetchContext(self):
+
+        return {"use_file_order": self.useFileOrder,
+                "use_volume_cache": self.useVolumeCache,
+                "save_directory": self.saveDirectory,
+                "save_format": self.saveFormat,
+                "labels": tuple(self.currentMaskStack)}
+
+    def prefetchNeighbours(self):
+
+        if self.usePrefetch and self.annotableDirectory is not None and len(self.annotableFolders) != 0:
+            neighbours = []
+            for index in (self.annotableIndex + 1, self.annotableIndex - 1):
+                if 0 <= index < len(self.annotableFolders):
+                    neighbours.append(Path(self.annotableDirectory) / self.annotableFolders[index])
+            self.examPrefetcher.prefetch(neighbours, self.prefetchContext())
+        else:
+            self.examPrefetcher.clear()
+
     def saveMasks(self):
 
         QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
@@ -1000,20 +1087,22 @@ class DLLabelsCT(QMainWindow):
                 self.progressBar.show()
                 study_id = Path(self.DICOMFolderPath).name
                 save_dir = Path(self.saveDirectory)
-                os.makedirs(save_dir / study_id / maskType, exist_ok=True)
-                mask_stack = self.currentMaskStack[maskType].copy()
+                mask_stack = self.currentMaskStack[maskType]
                 if self.removeOutliers:
                     mask_stack = remove_outliers(mask_stack)
-                elif mask_stack.max() == 1:
-                    mask_stack = mask_stack.astype("uint8")
-                    mask_stack = mask_stack * 255
-                elif mask_stack.max() == 255:
-                    mask_stack = mask_stack.astype("uint8")
-                for slice_num, slice in enumerate(mask_stack):
+                if self.saveFormat == "npz":
+                    exam = self.annotatedExam({maskType: mask_stack}, images=False)
+                    annotation_writers["npz"].write(save_dir / study_id, exam, self.progressBar.setValue)
+                    self.statusbar.showMessage("Saving complete")
+                    continue
+                os.makedirs(save_dir / study_id / maskType, exist_ok=True)
+                jobs = []
+                for slice_num in range(len(mask_stack)):
                     mask_filename = study_id + "_" + str(slice_num) + ".png"
                     mask_save_path = save_dir / study_id / maskType / mask_filename
-                    cv2.imwrite(str(mask_save_path), slice)
-                    self.progressBar.setValue(int(slice_num * (100 / len(mask_stack))))
+                    jobs.append((mask_save_path, partial(self.volumeView.plane, mask_stack, "axial", slice_num)))
+                for tmp, mask_save_path, _ in self.sliceIO.write(jobs, self.pngCompression, self.dicomLoader.progressCallback):
+                    os.replace(tmp, mask_save_path)
                 self.statusbar.showMessage("Saving complete")
             elif self.currentStudyID is None:
                 self.statusbar.showMessage("Select DICOMs before saving!")
@@ -1038,18 +1127,26 @@ class DLLabelsCT(QMainWindow):
                 else:
                     for maskType in self.currentMaskStack:
                         maskDirectory = Path(loadDirectory) / maskType
-                        if os.path.isdir(maskDirectory):
+                        maskStack = annotation_writers["npz"].read(loadDirectory, Path(self.DICOMFolderPath).name, maskType, self.currentDICOMStack.shape)
+                        if maskStack is not None:
+                            # Volume files are saved in the stored orientation
+                            if self.removeOutliers:
+                                maskStack = remove_outliers(maskStack)
+                            self.currentMaskStack[maskType] = maskStack
+                            self.axialImageScene.createMask(maskType)
+                            self.updateImages()
+                            self.axialImageScene.maskShown = True
+                            self.statusbar.showMessage("Loading complete")
+                        elif os.path.isdir(maskDirectory):
                             maskList = list(maskDirectory.glob("*.png"))
                             masks = sorted(maskList, key=lambda i: int(os.path.splitext(os.path.basename(i).split("_")[-1])[0]))
                             if len(masks) != len(self.dicoms):
                                 self.statusbar.showMessage("Invalid number of masks in directory!")
                             else:
                                 self.progressBar.show()
-                                maskStack = np.zeros(self.currentDICOMStack.shape)
-                                for i, mask_path in enumerate(masks):
-                                    mask = cv2.imread(str(mask_path), 0)
-                                    maskStack[i, :, :] = mask
-                                    self.progressBar.setValue(int(i * (100 / len(maskStack))))
+                                maskStack = MaskVolume(self.currentDICOMStack.shape)
+                                for i, mask in enumerate(self.sliceIO.read(masks, self.dicomLoader.progressCallback)):
+                                    maskStack[self.volumeView.source(0, i), :, :] = self.volumeView.orient(mask, "axial")
                                 self.progressBar.setValue(100)
                                 if self.removeOutliers:
                                     maskStack = remove_outliers(maskStack)
@@ -1137,7 +1234,7 @@ class DLLabelsCT(QMainWindow):
                         self.labelTable.item(rowPos, 2).setBackground(QColor(labelRed, labelGreen, labelBlue))
                 if self.currentDICOMStack is not None:
                     for maskType in self.currentMaskStack:
-                        self.currentMaskStack[maskType] = np.zeros(self.currentDICOMStack.shape)
+                        self.currentMaskStack[maskType] = MaskVolume(self.currentDICOMStack.shape)
                         self.axialImageScene.createMask(maskType)
                     self.updateImages()
             else:
@@ -1148,64 +1245,40 @@ class DLLabelsCT(QMainWindow):
 
         QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
         if not any(value is None for value in self.currentMaskStack.values()) and self.currentStudyID is not None and self.saveDirectory is not None:
-            self.progressBar.show()
-            study_id = Path(self.DICOMFolderPath).name
-            save_dir = Path(self.saveDirectory)
-            os.makedirs(save_dir / "images", exist_ok=True)
-            progress_value = 0
-            max_progress_value = len(list(self.currentMaskStack)) * self.currentDICOMStack.shape[0]
-            image_stack = self.currentDICOMStack.copy()
-            if any(value.isChecked() is True for value in self.agFlip.actions()) and self.saveImages and self.saveFlipped:
-                for slice_num, image in enumerate(image_stack):
-                    filename = study_id + "_" + str(slice_num) + ".png"
-                    image_dir_flip = save_dir / "images_flipped"
-                    image_save_path = image_dir_flip / filename
-                    os.makedirs(image_dir_flip, exist_ok=True)
-                    image_slice = image_stack[slice_num, :, :]
-                    cv2.imwrite(str(image_save_path), image_slice)
-            if self.agFlip.actions()[0].isChecked():
-                image_stack = np.flip(image_stack, 0)
-            if self.agFlip.actions()[1].isChecked():
-                image_stack = np.flip(image_stack, 1)
-            if self.agFlip.actions()[2].isChecked():
-                image_stack = np.flip(image_stack, 2)
-            if self.saveImages:
-                for slice_num, image in enumerate(image_stack):
-                    filename = study_id + "_" + str(slice_num) + ".png"
-                    image_save_path = save_dir / "images" / filename
-                    image_slice = image_stack[slice_num, :, :]
-                    cv2.imwrite(str(image_save_path), image_slice)
-            for i, maskType in enumerate(list(self.currentMaskStack)):
-                mask_dir = maskType.lower() + "_masks"
-                os.makedirs(save_dir / mask_dir, exist_ok=True)
-                current_mask_stack = self.currentMaskStack[maskType].copy()
-                if self.removeOutliers:
-                    current_mask_stack = remove_outliers(current_mask_stack)
-                elif current_mask_stack.max() == 1:
-                    current_mask_stack = current_mask_stack.astype("uint8")
-                    current_mask_stack = current_mask_stack * 255
-                elif current_mask_stack.max() == 255:
-                    current_mask_stack = current_mask_stack.astype("uint8")
-                if any(value.isChecked() is True for value in self.agFlip.actions()) and self.saveFlipped:
-                    for slice_num, current_mask_slice in enumerate(current_mask_stack):
-                        mask_dir_flip = mask_dir + "_flipped"
-                        os.makedirs(save_dir / mask_dir_flip, exist_ok=True)
-                        filename = study_id + "_" + str(slice_num) + ".png"
-                        current_mask_save_path = save_dir / mask_dir_flip / filename
-                        cv2.imwrite(str(current_mask_save_path), current_mask_slice)
-                if self.agFlip.actions()[0].isChecked():
-                    current_mask_stack = np.flip(current_mask_stack, 0)
-                if self.agFlip.actions()[1].isChecked():
-                    current_mask_stack = np.flip(current_mask_stack, 1)
-                if self.agFlip.actions()[2].isChecked():
-                    current_mask_stack = np.flip(current_mask_stack, 2)
-                for slice_num, current_mask_slice in enumerate(current_mask_stack):
-                    filename = study_id + "_" + str(slice_num) + ".png"
-                    current_mask_save_path = save_dir / mask_dir / filename
-                    cv2.imwrite(str(current_mask_save_path), current_mask_slice)
-                    progress_value += 1
-                    self.progressBar.setValue(int(progress_value * (100 / max_progress_value)))
-            self.statusbar.showMessage("Saving complete")
+            # Only labels and slices changed since the last save are written, unless a setting that changes the
+            # saved masks did change, and images only when a setting that changes them did. Outlier removal works
+            # on the whole volume, so it rewrites changed labels whole
+            saveSettings = self.saveSettings()
+            maskSettings, imageSettings = saveSettings
+            savedMaskSettings, savedImageSettings = self.savedExam if self.savedExam is not None else (None, None)
+            changed = maskSettings != savedMaskSettings
+            masks = {}
+            slices = {}
+            for maskType, mask_stack in self.currentMaskStack.items():
+                target = self.segmentationTargets.get(maskType)
+                if target is not None and target[1] is mask_stack:
+                    # Labels still being segmented are saved as they were before the run
+                    mask_stack = target[2]
+                    if mask_stack is None:
+                        continue
+                if changed or mask_stack.dirty:
+                    slices[maskType] = None if changed or self.removeOutliers else set(mask_stack.dirty)
+                    masks[maskType] = mask_stack.snapshot()
+                    mask_stack.markSaved(slices[maskType])
+            images = self.saveImages and imageSettings != savedImageSettings
+            if masks or images:
+                if images and isinstance(self.currentDICOMStack, LazyVolume) and not self.currentDICOMStack.complete():
+                    # Slices are decoded here with the loader's progress, not in the saving thread
+                    self.progressBar.show()
+                    np.asarray(self.currentDICOMStack)
+                    self.progressBar.hide()
+                exam = self.annotatedExam(masks, images=images)
+                exam["slices"] = slices
+                self.annotationSaver.save(annotation_writers[self.saveFormat], self.saveDirectory, exam, self.removeOutliers)
+                self.savedExam = saveSettings
+                self.statusbar.showMessage(f"Saving {exam['study_id']}...")
+            else:
+                self.statusbar.showMessage("Saving complete")
         elif self.currentStudyID is None:
             self.statusbar.showMessage("Select DICOMs before saving!")
         elif self.currentMaskStack is None:
@@ -1217,47 +1290,85 @@ class DLLabelsCT(QMainWindow):
         self.progressBar.hide()
         QApplication.restoreOverrideCursor()
 
-    def loadAnnotations(self):
+    def rebuildManifest(self):
+
+        if self.saveDirectory is not None:
+            QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+            self.annotationSaver.flush()
+            try:
+                annotation_manifest(self.saveDirectory).rebuild(checksums=True)
+            except OSError as e:
+                self.statusbar.showMessage(f"Rebuilding annotation index failed: {e}")
+            else:
+                self.statusbar.showMessage("Annotation index rebuilt")
+            QApplication.restoreOverrideCursor()
+        else:
+            self.statusbar.showMessage("Select save folder before rebuilding the annotation index!")
+
+    def showSaveProgress(self, studyID, value):
+
+        self.statusbar.showMessage(f"Saving {studyID}... {value}%")
+
+    def saveFinished(self, studyID):
+
+        if not self.annotationSaver.pending():
+            self.statusbar.showMessage("Saving complete")
+
+    def saveFailed(self, studyID, error):
+
+        # Everything of the exam is written again on its next save
+        if Path(self.DICOMFolderPath).name == studyID:
+            self.savedExam = None
+        self.statusbar.showMessage(f"Saving {studyID} failed: {error}")
+
+    def saveSettings(self):
+
+        # Everything besides the masks that decides what saveAnnotations writes, for the masks and for the
+        # images. Images are only windowed when saved as PNG slices, npz files keep the HU volume
+        window = (self.dicomWindowCenter, self.dicomWindowWidth, self.invertDICOMs) if self.saveFormat == "png" else None
+        return ((self.saveDirectory, self.saveFormat, self.saveFlipped, self.removeOutliers, self.volumeView.flips),
+                (self.saveDirectory, self.saveFormat, self.saveImages, self.saveFlipped, window, self.volumeView.flips))
+
+    def annotatedExam(self, masks, images=True):
+
+        # What the annotation writers save of the current exam
+        spacing = [[self.pixelSpacingX.get(str(i), 1.0), self.pixelSpacingY.get(str(i), 1.0)] for i in range(self.currentDICOMStack.shape[0])]
+        return {"study_id": Path(self.DICOMFolderPath).name,
+                "masks": masks,
+                "colors": {maskType: self.maskColors.get(maskType, [0, 0, 0]) for maskType in masks},
+                "spacing": spacing,
+                "images": self.currentDICOMStack if images else None,
+                "lut": self.windowLUT,
+                "view": self.volumeView,
+                "save_flipped": self.saveFlipped,
+                "compression": self.pngCompression}
+
+    def loadAnnotations(self, prefetchedMasks=None):
 
         QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
         if self.currentStudyID is not None and self.saveDirectory is not None:
+            otherFormat = False
             for maskType in self.currentMaskStack:
                 self.progressBar.show()
                 studyID = Path(self.DICOMFolderPath).name
-                saveDirectory = Path(self.saveDirectory)
-                currentMasks = maskType.lower() + "_masks"
-                loadDirectory = saveDirectory / currentMasks
-                if os.path.isdir(loadDirectory):
-                    mask_list_orig = list((Path(loadDirectory).rglob("*.png")))
-                    mask_list = []
-                    for mask in mask_list_orig:
-                        if studyID in str(mask):
-                            mask_list.append(mask)
-                    masks = sorted(mask_list, key=lambda i: int(os.path.splitext(os.path.basename(i).split("_")[-1])[0]))
-                    if len(masks) != len(self.dicoms):
-                        pass
-                    else:
-                        self.progressBar.show()
-                        mask_stack = np.zeros(self.currentDICOMStack.shape)
-                        for i, mask_path in enumerate(masks):
-                            mask = cv2.imread(str(mask_path), 0)
-                            mask_stack[i, :, :] = mask
-                            self.progressBar.setValue(int(i * (100 / len(mask_stack))))
-                        if self.agFlip.actions()[0].isChecked():
-                            mask_stack = np.flip(mask_stack, 0)
-                        if self.agFlip.actions()[1].isChecked():
-                            mask_stack = np.flip(mask_stack, 1)
-                        if self.agFlip.actions()[2].isChecked():
-                            mask_stack = np.flip(mask_stack, 2)
-                        self.progressBar.setValue(100)
-                        if self.removeOutliers:
-                            mask_stack = remove_outliers(mask_stack)
-                        self.currentMaskStack[maskType] = mask_stack
-                        self.axialImageScene.createMask(maskType)
-                        self.updateImages()
-                        self.axialImageScene.maskShown = True
-                        if self.setOpacitySlider.isHidden():
-                            self.setOpacitySlider.show()
+                if prefetchedMasks is not None:
+                    mask_stack = prefetchedMasks.get(maskType)
+                else:
+                    self.annotationSaver.wait(self.saveDirectory, studyID)
+                    mask_stack = read_study_masks(self.saveDirectory, studyID, maskType, self.currentDICOMStack.shape, self.progressBar.setValue, self.saveFormat)
+                if mask_stack is not None:
+                    self.progressBar.setValue(100)
+                    # Masks read from the other save format are dirty, the next save writes the exam whole
+                    otherFormat = otherFormat or bool(mask_stack.dirty)
+                    if self.removeOutliers:
+                        mask_stack = remove_outliers(mask_stack)
+                    self.currentMaskStack[maskType] = mask_stack
+                    self.savedExam = None if otherFormat else self.saveSettings()
+                    self.axialImageScene.createMask(maskType)
+                    self.updateImages()
+                    self.axialImageScene.maskShown = True
+                    if self.setOpacitySlider.isHidden():
+                        self.setOpacitySlider.show()
             self.statusbar.showMessage("Loading complete")
             self.progressBar.hide()
         elif self.saveDirectory is None:
@@ -1285,6 +1396,7 @@ class DLLabelsCT(QMainWindow):
                 self.coronalIndexLabel.show()
                 if self.currentDICOMStack is not None:
                     self.coronalImageLabel.setMinimumWidth(540)
+                    self.updateSingleImage("coronal")
             else:
                 self.coronalImageLabel.hide()
                 self.coronalSlider.hide()
@@ -1298,6 +1410,7 @@ class DLLabelsCT(QMainWindow):
                 self.sagittalIndexLabel.show()
                 if self.currentDICOMStack is not None:
                     self.sagittalImageLabel.setMinimumWidth(540)
+                    self.updateSingleImage("sagittal")
             else:
                 self.sagittalImageLabel.hide()
                 self.sagittalSlider.hide()
@@ -1314,60 +1427,76 @@ class DLLabelsCT(QMainWindow):
             self.setOpacitySlider.show()
             self.updateImages()
 
-    def showImages(self, imagesChanged=True):
+    def openLazyVolume(self, series, signature=None):
+
+        # Large series are decoded slice by slice into a memory-mapped file, which becomes the cache entry once complete
+        if signature is not None:
+            tmp = self.volumeCache.reserve()
+            if tmp is not None:
+                self.lazyReservation = tmp
+                return self.dicomLoader.loadLazy(series, tmp / "volume.npy",
+                                                 lambda volume: self.commitLazyVolume(signature, series, tmp))
+        return self.dicomLoader.loadLazy(series)
+
+    def commitLazyVolume(self, signature, series, tmp):
+
+        if self.lazyReservation == tmp:
+            self.lazyReservation = None
+        self.volumeCache.commit(signature, series, tmp)
+
+    def releaseLazyVolume(self):
+
+        # The file of a lazily opened exam that was left before every slice was decoded is not a cache entry,
+        # it is deleted instead of being left in the cache folder
+        if self.lazyReservation is not None:
+            self.volumeCache.release(self.lazyReservation)
+            self.lazyReservation = None
+
+    def showImages(self, imagesChanged=True, prefetched=None):
 
         if self.dicoms and self.currentDICOMStack is None:
+            self.cancelSegmentation(wait=True)
+            self.releaseLazyVolume()
             self.progressBar.show()
             try:
-                for i, dicomPath in enumerate(self.dicoms):
-                    try:
-                        ds = dcmread(dicomPath)
-                    except pydicom.errors.InvalidDicomError:
-                        self.statusbar.showMessage("No DICOMS or invalid DICOMs in folder!")
-                        self.progressBar.hide()
-                        self.currentDICOMStack = None
-                        return 0
-                    except IsADirectoryError:
-                        self.statusbar.showMessage("Folder contains another folder!")
-                        self.progressBar.hide()
-                        self.currentDICOMStack = None
-                        return 0
-                    except PermissionError:
-                        self.statusbar.showMessage("Invalid DICOMs in folder or folder contains another folder!")
-                        self.progressBar.hide()
-                        self.currentDICOMStack = None
-                        return 0
-                    try:
-                        self.currentStudyID = ds.StudyID
-                    except AttributeError:
-                        self.currentStudyID = 0
-                    out = adjust_image(ds, self.dicomWindowCenter, self.dicomWindowWidth)
-                    if i == 0:
-                        self.currentDICOMStack = np.zeros((len(self.dicoms), out.shape[0], out.shape[1]))
-                        self.pixelSpacingX = {}
-                        self.pixelSpacingY = {}
-
-                    if self.useFileOrder:
-                        self.currentDICOMStack[i, :, :] = out.astype(np.uint16)
-                        self.pixelSpacingX[str(i)] = float(ds.PixelSpacing[0])
-                        self.pixelSpacingY[str(i)] = float(ds.PixelSpacing[1])
+                series = None
+                if prefetched is not None:
+                    self.currentDICOMStack, series = prefetched["stack"], prefetched["series"]
+                elif self.useVolumeCache:
+                    signature = self.volumeCache.signature(self.dicoms, self.useFileOrder)
+                    self.currentDICOMStack, series = self.volumeCache.load(signature)
+                if series is None:
+                    series = self.dicomLoader.scan(self.dicoms, self.useFileOrder)
+                    if np.prod(series["shape"]) * 2 > self.lazyVolumeSize * 1024**3:
+                        self.currentDICOMStack = self.openLazyVolume(series, signature if self.useVolumeCache else None)
                     else:
-                        try:
-                            self.currentDICOMStack[ds.InstanceNumber-1, :, :] = out.astype(np.uint16)
-                            self.pixelSpacingX[str(ds.InstanceNumber-1)] = float(ds.PixelSpacing[0])
-                            self.pixelSpacingY[str(ds.InstanceNumber-1)] = float(ds.PixelSpacing[1])
-                        except AttributeError:
-                            self.currentDICOMStack[i, :, :] = out.astype(np.uint16)
-                            self.pixelSpacingX[str(i)] = float(ds.PixelSpacing[0])
-                            self.pixelSpacingY[str(i)] = float(ds.PixelSpacing[1])
-                        except IndexError:
-                            self.statusbar.showMessage("Invalid DICOM index!")
-                            continue
-                    self.progressBar.setValue(int(i * (100 / len(self.dicoms))))
+                        self.currentDICOMStack = self.dicomLoader.load(series)
+                        if self.useVolumeCache:
+                            self.currentDICOMStack = self.volumeCache.store(signature, series, self.currentDICOMStack)
+            except pydicom.errors.InvalidDicomError:
+                self.statusbar.showMessage("No DICOMS or invalid DICOMs in folder!")
+                self.progressBar.hide()
+                self.currentDICOMStack = None
+                return 0
+            except IsADirectoryError:
+                self.statusbar.showMessage("Folder contains another folder!")
+                self.progressBar.hide()
+                self.currentDICOMStack = None
+                return 0
+            except PermissionError:
+                self.statusbar.showMessage("Invalid DICOMs in folder or folder contains another folder!")
+                self.progressBar.hide()
+                self.currentDICOMStack = None
+                return 0
             except ValueError:
                 self.statusbar.showMessage("Invalid DICOMs (wrong shape)!")
                 self.progressBar.hide()
+                self.currentDICOMStack = None
                 return 0
+            self.currentStudyID = series["study_id"]
+            self.invertDICOMs = series["invert"]
+            self.pixelSpacingX = series["spacing_x"]
+            self.pixelSpacingY = series["spacing_y"]
             self.axialImageLabel.setMinimumWidth(540)
             self.coronalImageLabel.setMinimumWidth(540)
             self.sagittalImageLabel.setMinimumWidth(540)
@@ -1381,49 +1510,24 @@ class DLLabelsCT(QMainWindow):
                 self.axialSlider.setValue(0)
                 self.coronalSlider.setValue(0)
                 self.sagittalSlider.setValue(0)
-            self.currentDICOMStack = self.currentDICOMStack.astype(np.uint16)
-            if self.agFlip.actions()[0].isChecked():
-                self.currentDICOMStack = np.flip(self.currentDICOMStack, 0)
-            if self.agFlip.actions()[1].isChecked():
-                self.currentDICOMStack = np.flip(self.currentDICOMStack, 1)
-            if self.agFlip.actions()[2].isChecked():
-                self.currentDICOMStack = np.flip(self.currentDICOMStack, 2)
-            axialImage = self.currentDICOMStack[self.axialDICOMIndex, :, :].copy()
-            coronalImage = self.currentDICOMStack[:, self.coronalDICOMIndex, :].copy()
-            sagittalImage = self.currentDICOMStack[:, :, self.sagittalDICOMIndex].copy()
-
-            h, w = axialImage.shape
-            self.axialImageQt = QImage(axialImage, w, h, w * 2, QImage.Format.Format_Grayscale16)
-            self.axialImageQt = QPixmap.fromImage(self.axialImageQt)
-            self.axialImageScene.clear()
-            self.axialImageScene.addPixmap(self.axialImageQt)
-
-            h, w = coronalImage.shape
-            coronalImageQt = QImage(coronalImage, w, h, w * 2, QImage.Format.Format_Grayscale16)
-            coronalImageQt = QPixmap.fromImage(coronalImageQt)
-            self.coronalImageScene.clear()
-            self.coronalImageScene.addPixmap(coronalImageQt)
-
-            h, w = sagittalImage.shape
-            sagittalImageQt = QImage(sagittalImage, w, h, w * 2, QImage.Format.Format_Grayscale16)
-            sagittalImageQt = QPixmap.fromImage(sagittalImageQt)
-            self.sagittalImageScene.clear()
-            self.sagittalImageScene.addPixmap(sagittalImageQt)
-
-            try:
-                self.currentPatientIDLabel.setText(f"Patient ID: {ds.PatientID}")
-            except AttributeError:
-                self.currentPatientIDLabel.setText(f"Patient ID: None")
-
-            self.axialIndexLabel.setText(f"{self.axialDICOMIndex} / {len(self.dicoms) - 1}")
-            self.coronalIndexLabel.setText(f"{self.coronalDICOMIndex} / {axialImage.shape[0] - 1}")
-            self.sagittalIndexLabel.setText(f"{self.sagittalDICOMIndex} / {axialImage.shape[1] - 1}")
-            self.coronalSlider.setRange(0, axialImage.shape[0] - 1)
-            self.sagittalSlider.setRange(0, axialImage.shape[1] - 1)
+            self.volumeView = VolumeView(self.currentDICOMStack.shape, [action.isChecked() for action in self.agFlip.actions()])
+            self.savedExam = None
+            self.examToken += 1
+            self.pixmapCache.clear()
+            self.slicePrerenderer.cancel()
+            self.applyWindowing()
             for maskType in self.currentMaskStack:
                 if self.currentMaskStack[maskType] is None:
-                    self.currentMaskStack[maskType] = np.zeros(self.currentDICOMStack.shape)
+                    self.currentMaskStack[maskType] = MaskVolume(self.currentDICOMStack.shape)
                     self.axialImageScene.createMask(maskType)
+            self.updateSingleImage("axial")
+            self.updateSingleImage("coronal")
+            self.updateSingleImage("sagittal")
+
+            self.currentPatientIDLabel.setText(f"Patient ID: {series['patient_id']}")
+
+            self.coronalSlider.setRange(0, self.currentDICOMStack.shape[1] - 1)
+            self.sagittalSlider.setRange(0, self.currentDICOMStack.shape[2] - 1)
 
             if self.axialImageLabel.isVisible():
                 self.axialSlider.show()
@@ -1451,25 +1555,14 @@ class DLLabelsCT(QMainWindow):
         self.progressBar.hide()
         return 1
 
+    def applyWindowing(self):
+
+        self.windowLUT = window_lut(self.dicomWindowCenter, self.dicomWindowWidth, self.invertDICOMs)
+        self.axialLUTSettings = None
+
     def updateImages(self):
 
         if self.dicoms and self.currentDICOMStack is not None:
-            if any(self.flip.values()):
-                if self.flip["Axial"]:
-                    self.currentDICOMStack = np.flip(self.currentDICOMStack, 0)
-                if self.flip["Coronal"]:
-                    self.currentDICOMStack = np.flip(self.currentDICOMStack, 1)
-                if self.flip["Sagittal"]:
-                    self.currentDICOMStack = np.flip(self.currentDICOMStack, 2)
-                for maskType, mask in self.currentMaskStack.items():
-                    if self.currentMaskStack[maskType] is not None:
-                        if self.flip["Axial"]:
-                            self.currentMaskStack[maskType] = np.flip(self.currentMaskStack[maskType], 0)
-                        if self.flip["Coronal"]:
-                            self.currentMaskStack[maskType] = np.flip(self.currentMaskStack[maskType], 1)
-                        if self.flip["Sagittal"]:
-                            self.currentMaskStack[maskType] = np.flip(self.currentMaskStack[maskType], 2)
-
             self.updateSingleImage("axial")
             self.updateSingleImage("coronal")
             self.updateSingleImage("sagittal")
@@ -1486,198 +1579,296 @@ class DLLabelsCT(QMainWindow):
 
     def updateSingleImage(self, imageType):
 
+        self.renderScheduler.discard(imageType)
+        # Hidden coronal and sagittal views are rendered when shown, so a lazily loaded exam only decodes
+        # the slices of the axial view until then
+        if imageType == "coronal" and self.coronalImageLabel.isHidden():
+            return
+        if imageType == "sagittal" and self.sagittalImageLabel.isHidden():
+            return
         if self.dicoms and self.currentDICOMStack is not None:
             if imageType == "axial":
-                try:
-                    image = self.currentDICOMStack[self.axialDICOMIndex, :, :].copy()
-                except (ValueError, IndexError):
-                    self.axialDICOMIndex = 0
-                    image = self.currentDICOMStack[self.axialDICOMIndex, :, :].copy()
-                image = image.astype(np.float64)
-                image = image*self.contrast + self.brightness
-                image = np.clip(image, 0, 65535)
-                image = image.astype(np.uint16)
-                h, w = image.shape
-                self.axialImageQt = QImage(image, w, h, w * 2, QImage.Format.Format_Grayscale16)
-                self.axialImageQt = QPixmap.fromImage(self.axialImageQt)
-                self.axialImageScene.clear()
-                self.axialImageScene.addPixmap(self.axialImageQt)
+                self.axialImageQt = self.slicePixmap("axial")
+                self.axialImageScene.setImage(self.axialImageQt)
+                self.axialImageScene.setOverlay(self.sliceOverlay("axial"))
                 self.axialIndexLabel.setText(f"{self.axialDICOMIndex} / {len(self.dicoms) - 1}")
-                combination = QPixmap(w, h)
-                combination.fill(Qt.GlobalColor.transparent)
-                p = QPainter(combination)
-                p.drawPixmap(0, 0, w, h, self.axialImageQt)
             elif imageType == "coronal":
-                try:
-                    image = self.currentDICOMStack[:, self.coronalDICOMIndex, :].copy()
-                except (ValueError, IndexError):
-                    self.coronalDICOMIndex = 0
-                    image = self.currentDICOMStack[:, self.coronalDICOMIndex, :].copy()
-                h, w = image.shape
-                imageQt = QImage(image, w, h, w * 2, QImage.Format.Format_Grayscale16)
-                imageQt = QPixmap.fromImage(imageQt)
-                self.coronalImageScene.clear()
-                self.coronalImageScene.addPixmap(imageQt)
+                self.coronalImageScene.setImage(self.slicePixmap("coronal"))
+                self.coronalImageScene.setOverlay(self.sliceOverlay("coronal"))
                 self.coronalIndexLabel.setText(f"{self.coronalDICOMIndex} / {self.currentDICOMStack.shape[1] - 1}")
-                combination = QPixmap(w, h)
-                combination.fill(Qt.GlobalColor.transparent)
-                p = QPainter(combination)
-                p.drawPixmap(0, 0, w, h, imageQt)
             elif imageType == "sagittal":
-                try:
-                    image = self.currentDICOMStack[:, :, self.sagittalDICOMIndex].copy()
-                except (ValueError, IndexError):
-                    self.sagittalDICOMIndex = 0
-                    image = self.currentDICOMStack[:, :, self.sagittalDICOMIndex].copy()
-                h, w = image.shape
-                imageQt = QImage(image, w, h, w * 2, QImage.Format.Format_Grayscale16)
-                imageQt = QPixmap.fromImage(imageQt)
-                self.sagittalImageScene.clear()
-                self.sagittalImageScene.addPixmap(imageQt)
+                self.sagittalImageScene.setImage(self.slicePixmap("sagittal"))
+                self.sagittalImageScene.setOverlay(self.sliceOverlay("sagittal"))
                 self.sagittalIndexLabel.setText(f"{self.sagittalDICOMIndex} / {self.currentDICOMStack.shape[2] - 1}")
-                combination = QPixmap(w, h)
-                combination.fill(Qt.GlobalColor.transparent)
-                p = QPainter(combination)
-                p.drawPixmap(0, 0, w, h, imageQt)
-            for maskType in self.currentMaskStack:
-                if self.currentMaskStack[maskType] is not None and self.showMasks and maskType not in self.hiddenLabels:
-                    try:
-                        if imageType == "axial":
-                            mask = self.currentMaskStack[maskType][self.axialDICOMIndex, :, :].copy()
-                        elif imageType == "coronal":
-                            mask = self.currentMaskStack[maskType][:, self.coronalDICOMIndex, :].copy()
-                        elif imageType == "sagittal":
-                            mask = self.currentMaskStack[maskType][:, :, self.sagittalDICOMIndex].copy()
-                    except (ValueError, IndexError):
-                        pass
-                    else:
-                        mask = (np.stack((mask,) * 4, axis=-1) * 255).astype(np.uint8)
-                        mask = self.setMaskValues(mask, maskType)
-                        h, w, c = mask.shape
-                        maskQt = QImage(mask, w, h, c * w, QImage.Format.Format_RGBA8888)
-                        maskQt = QPixmap.fromImage(maskQt)
-                        p.drawPixmap(0, 0, w, h, maskQt)
-            p.end()
-            if imageType == "axial":
-                self.axialImageScene.clear()
-                self.axialImageScene.addPixmap(combination)
-            elif imageType == "coronal":
-                self.coronalImageScene.clear()
-                self.coronalImageScene.addPixmap(combination)
-            elif imageType == "sagittal":
-                self.sagittalImageScene.clear()
-                self.sagittalImageScene.addPixmap(combination)
+            self.prerenderNeighbours(imageType)
         self.statusbar.showMessage("")
 
-    def drawMask(self):
+    def viewIndex(self, imageType):
 
-        self.axialImageScene.clear()
-        self.axialImageScene.addPixmap(self.axialImageQt)
-        h, w = self.axialImageQt.height(), self.axialImageQt.width()
-        drawnMaskType = self.drawnMaskType
-        tempArray = self.currentMaskStack[drawnMaskType][self.axialDICOMIndex, :, :] + (self.axialImageScene.mask[drawnMaskType][self.axialDICOMIndex, :, :] * 255 * self.erasingOrDrawing)
-        tempArray[tempArray < 0] = 0
-        tempArray[tempArray > 255] = 255
-        self.currentMaskStack[drawnMaskType][self.axialDICOMIndex, :, :] = tempArray
-        self.axialImageScene.mask[drawnMaskType] = np.zeros(self.axialImageScene.mask[drawnMaskType].shape)
-        combinationAxial = QPixmap(w, h)
-        combinationAxial.fill(Qt.GlobalColor.transparent)
-        p = QPainter(combinationAxial)
-        p.drawPixmap(0, 0, w, h, self.axialImageQt)
-        for maskType in self.currentMaskStack:
-            if maskType in self.hiddenLabels:
+        # Out of range indexes (e.g. after opening a smaller exam) are reset to the first slice
+        if imageType == "axial":
+            if not 0 <= self.axialDICOMIndex < self.currentDICOMStack.shape[0]:
+                self.axialDICOMIndex = 0
+            return self.axialDICOMIndex
+        elif imageType == "coronal":
+            if not 0 <= self.coronalDICOMIndex < self.currentDICOMStack.shape[1]:
+                self.coronalDICOMIndex = 0
+            return self.coronalDICOMIndex
+        else:
+            if not 0 <= self.sagittalDICOMIndex < self.currentDICOMStack.shape[2]:
+                self.sagittalDICOMIndex = 0
+            return self.sagittalDICOMIndex
+
+    def viewLUT(self, imageType):
+
+        if imageType != "axial":
+            return self.windowLUT
+        if self.axialLUTSettings != (self.brightness, self.contrast):
+            self.axialLUT = adjust_lut(self.windowLUT, self.brightness, self.contrast)
+            self.axialLUTSettings = (self.brightness, self.contrast)
+        return self.axialLUT
+
+    def sliceKey(self, imageType, index=None, adjusted=True):
+
+        # Brightness and contrast are reset when the axial slice changes, so other axial slices are keyed
+        # without them (adjusted=False)
+        index = self.viewIndex(imageType) if index is None else index
+        flip = self.volumeView.flips
+        window = (self.dicomWindowCenter, self.dicomWindowWidth, self.invertDICOMs)
+        if imageType == "axial" and adjusted:
+            return self.examToken, "axial", index, window, self.brightness, self.contrast, flip
+        return self.examToken, imageType, index, window, 0, 1.0, flip
+
+    def slicePixmap(self, imageType):
+
+        key = self.sliceKey(imageType)
+        pixmap = self.pixmapCache.get(key)
+        if pixmap is None:
+            image = self.slicePrerenderer.take(key)
+            if image is None:
+                image = slice_image(self.currentDICOMStack, self.viewLUT(imageType), self.volumeView, imageType, self.viewIndex(imageType))
+            pixmap = QPixmap.fromImage(image)
+            if not self.axialImageScene.adjusting:
+                self.pixmapCache.put(key, pixmap)
+        return pixmap
+
+    def visibleMasks(self):
+
+        if not self.showMasks:
+            return []
+        return [(maskType, maskStack) for maskType, maskStack in self.currentMaskStack.items()
+                if maskStack is not None and maskType not in self.hiddenLabels]
+
+    def overlayKey(self, imageType, index):
+
+        labels = tuple((maskType, maskStack.version, tuple(self.maskColors[maskType])) for maskType, maskStack in self.visibleMasks())
+        return self.examToken, "overlay", imageType, index, self.maskOpacity, labels, self.volumeView.flips
+
+    def sliceOverlay(self, imageType):
+
+        overlay = self.slicePrerenderer.take(self.overlayKey(imageType, self.viewIndex(imageType)))
+        return self.maskOverlay(imageType) if overlay is None else overlay
+
+    def prerenderNeighbours(self, imageType):
+
+        # The next slices in the direction of travel are rendered first, then the one behind
+        index = self.viewIndex(imageType)
+        previous = self.renderedIndex[imageType]
+        if previous is not None and index != previous:
+            self.travelDirection[imageType] = 1 if index > previous else -1
+        self.renderedIndex[imageType] = index
+        stack = self.currentDICOMStack
+        if self.prerenderSlices == 0 or (isinstance(stack, LazyVolume) and not stack.complete() and imageType != "axial"):
+            return
+        # Slices rendered while brightness/contrast is being adjusted could never be shown
+        if self.axialImageScene.adjusting:
+            return
+        step = self.travelDirection[imageType]
+        size = stack.shape[["axial", "coronal", "sagittal"].index(imageType)]
+        lut = self.windowLUT
+        visible = self.visibleMasks()
+        masks = [maskStack for _, maskStack in visible]
+        overlayLUT = overlay_lut([self.maskColors[maskType] for maskType, _ in visible], self.maskOpacity)
+        jobs = []
+        for i in [index + step * n for n in range(1, self.prerenderSlices + 1)] + [index - step]:
+            if not 0 <= i < size:
                 continue
-            try:
-                axialMask = self.currentMaskStack[maskType][self.axialDICOMIndex, :, :].copy()
-            except (ValueError, IndexError):
-                pass
-            else:
-                axialMask = (np.stack((axialMask,) * 4, axis=-1) * 255).astype(np.uint8)
-                axialMask = self.setMaskValues(axialMask, maskType)
-                h, w, c = axialMask.shape
-                axialMaskQt = QImage(axialMask, w, h, c * w, QImage.Format.Format_RGBA8888)
-                axialMaskQt = QPixmap.fromImage(axialMaskQt)
-                p.drawPixmap(0, 0, w, h, axialMaskQt)
-        p.end()
-        self.axialImageScene.clear()
-        self.axialImageScene.addPixmap(combinationAxial)
-        self.statusbar.showMessage("")
+            key = self.sliceKey(imageType, i, adjusted=False)
+            if key not in self.pixmapCache:
+                jobs.append((key, partial(slice_image, stack, lut, self.volumeView, imageType, i)))
+            if masks:
+                jobs.append((self.overlayKey(imageType, i), partial(slice_overlay, masks, overlayLUT, self.volumeView, imageType, i, self.overlayShape(imageType))))
+        self.slicePrerenderer.prerender(imageType, jobs)
 
-    def setMaskValues(self, mask, maskType):
+    def overlayShape(self, imageType):
 
-        mask[:, :, 0][mask[:, :, 0] > 0] = self.maskColors[maskType][0]
-        mask[:, :, 1][mask[:, :, 1] > 0] = self.maskColors[maskType][1]
-        mask[:, :, 2][mask[:, :, 2] > 0] = self.maskColors[maskType][2]
-        mask[:, :, 3][mask[:, :, 3] > 0] = self.maskOpacity
+        if imageType == "axial":
+            return self.currentDICOMStack.shape[1], self.currentDICOMStack.shape[2]
+        elif imageType == "coronal":
+            return self.currentDICOMStack.shape[0], self.currentDICOMStack.shape[2]
+        return self.currentDICOMStack.shape[0], self.currentDICOMStack.shape[1]
 
-        return mask
+    def drawMask(self):
+
+        if self.renderScheduler.pending:
+            self.renderScheduler.flush()
+        rect, stroke = self.axialImageScene.takeStroke()
+        if rect is not None:
+            top, bottom, left, right = rect
+            index, sourceTop, _, sourceLeft, _ = self.volumeView.axialRect(self.axialDICOMIndex, top, bottom, left, right)
+            stroke = self.volumeView.orient(stroke, "axial")
+            self.currentMaskStack[self.drawnMaskType].paint(index, sourceTop, sourceLeft, stroke, self.erasingOrDrawing > 0)
+            if self.axialImageScene.overlay is None:
+                self.updateSingleImage("axial")
+            else:
+                self.axialImageScene.overlay[top:bottom, left:right] = self.maskOverlay("axial", top, bottom, left, right)
+                self.axialImageScene.updateOverlay(top, bottom, left, right)
+        self.statusbar.showMessage("")
+
+    def maskOverlay(self, imageType, top=0, bottom=None, left=0, right=None):
+
+        # RGBA overlay of the visible labels on the current axial slice (or a rectangle of it), or on the
+        # current coronal or sagittal slice
+        visible = self.visibleMasks()
+        lut = overlay_lut([self.maskColors[maskType] for maskType, _ in visible], self.maskOpacity)
+        if imageType == "axial":
+            h, w = self.overlayShape("axial")
+            bottom = h if bottom is None else bottom
+            right = w if right is None else right
+            shape = (bottom - top, right - left)
+            rect = self.volumeView.axialRect(self.axialDICOMIndex, top, bottom, left, right)
+            masks = [self.volumeView.orient(maskStack.axial(*rect), "axial") for _, maskStack in visible]
+        else:
+            shape = self.overlayShape(imageType)
+            masks = [self.volumeView.plane(maskStack, imageType, self.viewIndex(imageType)) for _, maskStack in visible]
+        return compose_overlay(masks, lut, shape)
 
     def doSegmentation(self):
 
-        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        if self.segmentationWorker is not None:
+            self.cancelSegmentation()
+            return
         modelType = self.segmentationModelType
         if modelType is None:
             self.statusbar.showMessage("Select what to segment!")
         elif modelType not in self.currentMaskStack and modelType != "multiple":
             self.statusbar.showMessage("Invalid model type!")
+        elif self.currentDICOMStack is None:
+            self.statusbar.showMessage("Select DICOMs")
+        elif self.segmentationModelPath is None:
+            self.statusbar.showMessage("Select model")
         else:
-            models = self.segmentationModelPath
-            stack = self.currentDICOMStack
-            device = self.device
-            indexes = self.indexesToSegment
-            if stack is None:
-                self.statusbar.showMessage("Select DICOMs")
-            elif self.segmentationModelPath is None:
-                self.statusbar.showMessage("Select model")
-            elif modelType == "multiple":
+            if modelType == "multiple":
                 classAmount = len(self.modelClasses)
                 if len(self.currentMaskStack) != classAmount or classAmount == 0:
                     self.statusbar.showMessage("Wrong number of classes!")
-                else:
-                    self.progressBar.show()
-                    self.statusbar.showMessage(" ")
-                    for maskType in self.currentMaskStack:
-                        self.axialImageScene.createMask(maskType)
-                    try:
-                        maskStack = segmentation(models, stack, device, indexes, classAmount, self)
-                    except AssertionError:
-                        self.statusbar.showMessage("CUDA not found, change device to CPU")
-                    except RuntimeError:
-                        self.statusbar.showMessage("Wrong model type!")
-                    else:
-                        if self.removeOutliers:
-                            for maskType in self.currentMaskStack:
-                                index = self.modelClasses[maskType]
-                                maskStack[:, index, :, :] = remove_outliers(maskStack[:, index, :, :])
-                        self.progressBar.setValue(100)
-                        for maskType in self.currentMaskStack:
-                            index = self.modelClasses[maskType]
-                            self.currentMaskStack[maskType] = maskStack[:, index, :, :]
-                        self.updateImages()
-                        self.axialImageScene.maskShown = True
-
-                        self.statusbar.showMessage("Segmentation done")
+                    return
+                targets = {maskType: self.modelClasses[maskType] for maskType in self.currentMaskStack}
             else:
+                classAmount = 1
+                targets = {modelType: 0}
+            stack = self.currentDICOMStack
+            if isinstance(stack, LazyVolume) and not stack.complete():
+                # Slices are decoded here with the loader's progress, not in the segmentation thread
                 self.progressBar.show()
-                self.statusbar.showMessage(" ")
-                self.axialImageScene.createMask(modelType)
-                try:
-                    maskStack = segmentation(models, stack, device, indexes, 1, self)
-                except AssertionError:
-                    self.statusbar.showMessage("CUDA not found, change device to CPU")
-                except RuntimeError:
-                    self.statusbar.showMessage("Wrong model type!")
-                else:
-                    if self.removeOutliers:
-                        maskStack = remove_outliers(maskStack)
-                    self.progressBar.setValue(100)
-                    self.currentMaskStack[modelType] = maskStack
-                    self.updateImages()
-                    self.axialImageScene.maskShown = True
+                stack = np.asarray(stack)
+            indexes = self.indexesToSegment
+            # Segmented slices are written into new masks as they finish, so the result fills in while scrolling.
+            # The previous masks are kept for saving during the run and are put back if it fails or is cancelled
+            self.segmentationTargets = {}
+            for maskType, classIndex in targets.items():
+                previous = self.currentMaskStack[maskType]
+                self.currentMaskStack[maskType] = MaskVolume(self.currentDICOMStack.shape)
+                self.axialImageScene.createMask(maskType)
+                self.segmentationTargets[maskType] = (classIndex, self.currentMaskStack[maskType], previous)
+            self.segmentationError = None
+            self.segmentationCancelled = False
+            # The model sees the slices as they are shown, the predictions are turned back in segmentedSlices
+            self.segmentationView = self.volumeView
+            worker = SegmentationWorker(self.segmentationModelPath, stack, self.windowLUT, self.volumeView, self.device, indexes, classAmount,
+                                        self.segmentationBatchSize, self.modelRegistry, parent=self)
+            worker.batchReady.connect(self.segmentedSlices)
+            worker.progress.connect(self.segmentationProgress)
+            worker.failed.connect(self.segmentationFailed)
+            worker.finished.connect(self.segmentationFinished)
+            worker.finished.connect(worker.deleteLater)
+            self.segmentationWorker = worker
+            self.progressBar.setValue(0)
+            self.progressBar.show()
+            self.doSegmentationButton.setText("Cancel segmentation")
+            self.statusbar.showMessage("Segmenting...")
+            self.updateImages()
+            self.axialImageScene.maskShown = True
+            worker.start()
+
+    def cancelSegmentation(self, wait=False):
+
+        worker = self.segmentationWorker
+        if worker is not None:
+            self.segmentationCancelled = True
+            worker.requestInterruption()
+            if wait:
+                # Results still queued from the worker are ignored after this
+                worker.wait()
+                self.restoreSegmentationTargets()
+                self.segmentationWorker = None
+                self.segmentationTargets = {}
+                self.doSegmentationButton.setText("Do segmentation")
+                self.progressBar.hide()
 
-                    self.statusbar.showMessage("Segmentation done")
-            self.progressBar.hide()
-        QApplication.restoreOverrideCursor()
+    def restoreSegmentationTargets(self):
+
+        for maskType, (_, maskStack, previous) in self.segmentationTargets.items():
+            if self.currentMaskStack.get(maskType) is maskStack:
+                self.currentMaskStack[maskType] = previous
+
+    def segmentedSlices(self, indexes, predictions):
+
+        if self.sender() is not self.segmentationWorker:
+            return
+        shown = False
+        view = self.segmentationView
+        for maskType, (classIndex, maskStack, _) in self.segmentationTargets.items():
+            for i, index in enumerate(indexes):
+                maskStack.setAxial(view.source(0, index), view.orient(predictions[i, classIndex], "axial"))
+            shown = shown or self.currentMaskStack.get(maskType) is maskStack
+        if shown:
+            self.renderScheduler.schedule("axial")
+            self.renderScheduler.schedule("coronal")
+            self.renderScheduler.schedule("sagittal")
+
+    def segmentationProgress(self, value):
+
+        if self.sender() is self.segmentationWorker:
+            self.progressBar.setValue(value)
+
+    def segmentationFailed(self, error):
+
+        if self.sender() is self.segmentationWorker:
+            self.segmentationError = error
+
+    def segmentationFinished(self):
+
+        worker = self.sender()
+        if worker is not self.segmentationWorker:
+            return
+        if self.segmentationError is not None or self.segmentationCancelled:
+            self.restoreSegmentationTargets()
+        elif self.removeOutliers:
+            for maskType, (_, maskStack, _) in self.segmentationTargets.items():
+                if self.currentMaskStack.get(maskType) is maskStack:
+                    self.currentMaskStack[maskType] = remove_outliers(maskStack)
+        self.segmentationWorker = None
+        self.segmentationTargets = {}
+        self.doSegmentationButton.setText("Do segmentation")
+        self.progressBar.hide()
+        self.updateImages()
+        if self.segmentationError is not None:
+            self.statusbar.showMessage(self.segmentationError)
+        elif self.segmentationCancelled:
+            self.statusbar.showMessage("Segmentation cancelled")
+        else:
+            self.statusbar.showMessage("Segmentation done")
 
     def removeOutliersFunc(self):
 
@@ -1702,13 +1893,13 @@ class DLLabelsCT(QMainWindow):
         if maskType is not None:
             maskStack = self.currentMaskStack[maskType]
             if maskStack is not None:
-                sliceNum = self.axialDICOMIndex
+                sliceNum = self.volumeView.source(0, self.axialDICOMIndex)
                 mask = maskStack[sliceNum, :, :]
                 mask = mask.astype(int)
                 seed = np.copy(mask)
                 seed[1:-1, 1:-1] = mask.max()
                 filled = reconstruction(seed, mask, method='erosion')
-                maskStack[sliceNum, :, :] = filled.astype(float)
+                maskStack[sliceNum, :, :] = filled
                 self.currentMaskStack[maskType] = maskStack
                 self.updateImages()
             else:
@@ -1719,6 +1910,7 @@ class DLLabelsCT(QMainWindow):
 
 def main():
 
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     dlLabelsCT = DLLabelsCT()
     dlLabelsCT.show()
@@ -0,0 +1,375 @@
+import os
+import json
+import shutil
+import zlib
+import tempfile
+import threading
+import numpy as np
+
+from functools import partial
+from pathlib import Path
+
+from gui_utils.image_utils import apply_lut
+from gui_utils.mask_utils import MaskVolume
+from gui_utils.png_utils import SliceIO
+from gui_utils.volume_utils import VolumeView
+
+
+def slice_file(path):
+
+    # Study ID and slice index of a <study>_<slice>.png file, study IDs may contain underscores
+    stem, extension = os.path.splitext(os.path.basename(path))
+    study_id, _, index = stem.rpartition("_")
+    if extension != ".png" or not study_id or not index.isdigit():
+        return None, None
+    return study_id, int(index)
+
+
+class AnnotationManifest:
+
+    """ Index of the annotations in a save folder, one json file per study in <save folder>/manifest.
+
+        A study's entry maps every label to its mask slice files with the volume shape and the CRC32 of
+        each file ("png"), and lists the labels and shape of its volume file ("npz", whose members carry
+        their own CRC32). Studies are matched by their exact ID, so loading an exam only opens its own
+        entry and files. The writers keep the manifest up to date, it is rebuilt from the files on disk
+        when it does not exist yet. Checksums and slice sizes are only read from the files when rebuilding
+        with checksums, otherwise they are left empty.
+
+        Files written to temporary files are moved into place through commit, which records the renames and
+        the new entry in <study>.json.pending first. A commit that was interrupted is completed the next
+        time the study is looked up or the manifest is rebuilt, so a study never keeps a mix of old and new
+        slices.
+    """
+
+    def __init__(self, save_directory):
+        self.save_directory = Path(save_directory)
+        self.directory = self.save_directory / "manifest"
+        self._lock = threading.RLock()
+
+    def path(self, study_id):
+        return self.directory / (study_id + ".json")
+
+    def pending(self, study_id):
+        return self.directory / (study_id + ".json.pending")
+
+    def study(self, study_id):
+        with self._lock:
+            if not self.directory.is_dir():
+                self.rebuild()
+            self._recover(study_id)
+            return self._read(study_id)
+
+    def _read(self, study_id):
+        try:
+            with open(self.path(study_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def masks(self, study_id, mask_type, shape):
+        # Mask slice files of a label in slice order, None if the study has no complete PNG masks of that shape
+        entry = self.study(study_id).get("png", {}).get(mask_type.lower())
+        if entry is None or len(entry["files"]) != shape[0]:
+            entry = self.find(study_id, mask_type, shape[0])
+        if entry is None or entry["shape"][0] != shape[0] or len(entry["files"]) != shape[0]:
+            return None
+        if entry["shape"][1:] != [None, None] and tuple(entry["shape"]) != tuple(shape):
+            return None
+        try:
+            return [self.save_directory / entry["files"][str(i)][0] for i in range(shape[0])]
+        except KeyError:
+            return None
+
+    def find(self, study_id, mask_type, slices):
+        # Mask slices saved without updating the manifest (by an older version or another annotator) are
+        # looked up in the label's folder and added to the manifest, None if the study has no complete set
+        folder = mask_type.lower() + "_masks"
+        files = {}
+        try:
+            for file in os.scandir(self.save_directory / folder):
+                file_study, index = slice_file(file.name)
+                if file_study == study_id:
+                    files[str(index)] = [folder + "/" + file.name, None]
+        except OSError:
+            return None
+        if set(files) != {str(i) for i in range(slices)}:
+            return None
+        label = {"shape": [slices, None, None], "files": files}
+        self.update(study_id, {"png": {mask_type.lower(): label}})
+        return label
+
+    def update(self, study_id, entry):
+        with self._lock:
+            study = self.study(study_id)
+            self._merge(study, entry)
+            self._write(self.directory, study_id, study)
+
+    def commit(self, study_id, renames, entry):
+        # renames are (temporary file, file) pairs, relative to the save folder
+        with self._lock:
+            study = self.study(study_id)
+            journal = {"renames": [[str(tmp), str(path)] for tmp, path in renames], "entry": entry}
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self.directory / (study_id + ".json.pending.tmp")
+            with open(tmp, "w") as f:
+                json.dump(journal, f)
+            os.replace(tmp, self.pending(study_id))
+            self._apply(study_id, study, journal)
+
+    def _recover(self, study_id):
+        try:
+            with open(self.pending(study_id)) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._apply(study_id, self._read(study_id), journal)
+
+    def _apply(self, study_id, study, journal):
+        for tmp, path in journal["renames"]:
+            if (self.save_directory / tmp).exists():
+                os.replace(self.save_directory / tmp, self.save_directory / path)
+        self._merge(study, journal["entry"])
+        self._write(self.directory, study_id, study)
+        os.remove(self.pending(study_id))
+
+    def _merge(self, study, entry):
+        for mask_type, label in entry.get("png", {}).items():
+            # Written slices are merged into the entry, which takes the saved shape so slice sizes left
+            # unknown by a rebuild are filled in. Only a volume of another shape replaces the old files
+            current = study.setdefault("png", {}).get(mask_type)
+            if current is None or current["shape"][0] != label["shape"][0] or \
+                    None not in current["shape"] and current["shape"] != label["shape"]:
+                study["png"][mask_type] = label
+            else:
+                current["files"].update(label["files"])
+                current["shape"] = label["shape"]
+        if "npz" in entry:
+            study["npz"] = entry["npz"]
+
+    def _write(self, directory, study_id, study):
+        os.makedirs(directory, exist_ok=True)
+        tmp = directory / (study_id + ".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(study, f)
+        os.replace(tmp, directory / (study_id + ".json"))
+
+    def rebuild(self, checksums=False):
+        with self._lock:
+            # Interrupted commits are completed first, their files and entries then come from the folder
+            if self.directory.is_dir():
+                for pending in self.directory.glob("*.json.pending"):
+                    self._recover(pending.name[:-len(".json.pending")])
+            studies = {}
+            if self.save_directory.is_dir():
+                for folder in os.scandir(self.save_directory):
+                    if folder.is_dir() and folder.name.endswith("_masks"):
+                        mask_type = folder.name[:-len("_masks")]
+                        for file in os.scandir(folder.path):
+                            study_id, index = slice_file(file.name)
+                            if study_id is None:
+                                continue
+                            label = studies.setdefault(study_id, {}).setdefault("png", {}).setdefault(mask_type, {"shape": [0, None, None], "files": {}})
+                            crc = None
+                            if checksums:
+                                data = np.fromfile(file.path, dtype=np.uint8)
+                                crc = zlib.crc32(data)
+                                # Width and height are the first fields of the IHDR chunk
+                                label["shape"][1:] = [int.from_bytes(data[20:24], "big"), int.from_bytes(data[16:20], "big")]
+                            label["files"][str(index)] = [folder.name + "/" + file.name, crc]
+                    elif folder.is_file() and folder.name.endswith(".npz"):
+                        try:
+                            with np.load(folder.path) as data:
+                                npz = {"file": folder.name,
+                                       "labels": [str(label) for label in data["labels"]],
+                                       "shape": [int(i) for i in data["shape"]]}
+                        except (OSError, ValueError, KeyError):
+                            continue
+                        studies.setdefault(folder.name[:-len(".npz")], {})["npz"] = npz
+            for study in studies.values():
+                for label in study.get("png", {}).values():
+                    label["shape"][0] = len(label["files"])
+            # Written to a new folder that replaces the old one, so readers never see a partial manifest
+            os.makedirs(self.save_directory, exist_ok=True)
+            tmp = Path(tempfile.mkdtemp(prefix=".manifest", dir=self.save_directory))
+            for study_id, study in studies.items():
+                self._write(tmp, study_id, study)
+            old = None
+            if self.directory.is_dir():
+                old = self.directory.with_name(tmp.name + ".old")
+                os.rename(self.directory, old)
+            os.rename(tmp, self.directory)
+            if old is not None:
+                shutil.rmtree(old, ignore_errors=True)
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def annotation_manifest(save_directory):
+
+    # One manifest object per save folder, so writes and rebuilds of the folder are serialized
+    with _manifests_lock:
+        key = str(Path(save_directory).resolve())
+        if key not in _manifests:
+            _manifests[key] = AnnotationManifest(save_directory)
+        return _manifests[key]
+
+
+def windowed_plane(stack, lut, view, index):
+
+    return apply_lut(view.plane(stack, "axial", index), lut)
+
+
+class PNGAnnotationWriter:
+
+    """ One PNG per slice, <save folder>/<label>_masks/<study>_<slice>.png for masks and
+        <save folder>/images/<study>_<slice>.png for windowed images, with copies in the displayed
+        orientation in the _flipped folders. Only the mask slices listed in the exam's "slices" are
+        written, None writes every slice. Slices are encoded in parallel with the exam's "compression"
+        level to temporary files, which are renamed into place through the manifest's commit only after
+        every file of the exam was written.
+    """
+
+    def __init__(self, slice_io=None):
+        self.slice_io = slice_io if slice_io is not None else SliceIO()
+
+    def write(self, save_directory, exam, progress=None):
+        save_dir = Path(save_directory)
+        study_id = exam["study_id"]
+        view = exam["view"]
+        unflipped = VolumeView(view.shape)
+        flipped = any(view.flips) and exam["save_flipped"]
+        image_stack = exam["images"]
+        jobs = []
+        if image_stack is not None:
+            os.makedirs(save_dir / "images", exist_ok=True)
+            if flipped:
+                os.makedirs(save_dir / "images_flipped", exist_ok=True)
+            for slice_num in range(image_stack.shape[0]):
+                filename = study_id + "_" + str(slice_num) + ".png"
+                if flipped:
+                    jobs.append((save_dir / "images_flipped" / filename, partial(windowed_plane, image_stack, exam["lut"], view, slice_num)))
+                jobs.append((save_dir / "images" / filename, partial(windowed_plane, image_stack, exam["lut"], unflipped, slice_num)))
+        for mask_type, mask_stack in exam["masks"].items():
+            mask_dir = save_dir / (mask_type.lower() + "_masks")
+            os.makedirs(mask_dir, exist_ok=True)
+            if flipped:
+                os.makedirs(str(mask_dir) + "_flipped", exist_ok=True)
+            indexes = exam.get("slices", {}).get(mask_type)
+            for slice_num in range(len(mask_stack)) if indexes is None else sorted(indexes):
+                filename = study_id + "_" + str(slice_num) + ".png"
+                if flipped:
+                    # Stored slice slice_num is shown at the same index mapped through the flip
+                    flipped_num = view.source(0, slice_num)
+                    path = Path(str(mask_dir) + "_flipped") / (study_id + "_" + str(flipped_num) + ".png")
+                    jobs.append((path, partial(view.plane, mask_stack, "axial", flipped_num)))
+                jobs.append((mask_dir / filename, partial(mask_stack.axial, slice_num)))
+        callback = None if progress is None else lambda done, total: progress(int(done * (100 / total)))
+        written = self.slice_io.write(jobs, exam.get("compression", 1), callback)
+        entry = {}
+        for mask_type, mask_stack in exam["masks"].items():
+            mask_dir = save_dir / (mask_type.lower() + "_masks")
+            files = {}
+            for _, path, crc in written:
+                if path.parent == mask_dir:
+                    files[str(slice_file(path)[1])] = [mask_dir.name + "/" + path.name, crc]
+            entry[mask_type.lower()] = {"shape": list(mask_stack.shape), "files": files}
+        renames = [(os.path.relpath(tmp, save_dir), os.path.relpath(path, save_dir)) for tmp, path, _ in written]
+        annotation_manifest(save_dir).commit(study_id, renames, {"png": entry})
+
+    def read(self, save_directory, study_id, mask_type, shape, progress=None):
+        masks = annotation_manifest(save_directory).masks(study_id, mask_type, shape)
+        if masks is None:
+            return None
+        mask_stack = MaskVolume(shape)
+        callback = None if progress is None else lambda done, total: progress(int(done * (100 / total)))
+        try:
+            for i, mask in enumerate(self.slice_io.read(masks, callback)):
+                if mask.shape != tuple(shape[1:]):
+                    return None
+                mask_stack.setAxial(i, mask)
+        except OSError:
+            # Files removed or replaced outside of the program, the manifest can be rebuilt from the folder
+            return None
+        return mask_stack
+
+
+class NPZAnnotationWriter:
+
+    """ One compressed <save folder>/<study>.npz per exam.
+
+        The file holds the bit-packed masks of every label ("mask_<i>" in the order of "labels"), the label
+        colors, the volume shape, the per-slice pixel spacing, the flips shown when saving and, when images
+        are saved, the HU volume. Labels and the HU volume that are not being saved are kept from the
+        previous file.
+    """
+
+    def path(self, save_directory, study_id):
+        return Path(save_directory) / (study_id + ".npz")
+
+    def write(self, save_directory, exam, progress=None):
+        path = self.path(save_directory, exam["study_id"])
+        masks = {label: mask_stack.packed for label, mask_stack in exam["masks"].items()}
+        colors = dict(exam["colors"])
+        image = exam["images"]
+        shape = next(iter(exam["masks"].values())).shape if masks else exam["images"].shape
+        if path.is_file():
+            with np.load(path) as data:
+                if tuple(data["shape"]) == tuple(shape):
+                    for i, label in enumerate(data["labels"]):
+                        if str(label) not in masks:
+                            masks[str(label)] = data[f"mask_{i}"]
+                            colors[str(label)] = data["colors"][i]
+                    if image is None and "image" in data.files:
+                        image = data["image"]
+        arrays = {"shape": np.array(shape),
+                  "labels": np.array(list(masks), dtype=str),
+                  "colors": np.array([colors.get(label, (0, 0, 0)) for label in masks], dtype=np.uint8).reshape(-1, 3),
+                  "spacing": np.array(exam["spacing"], dtype=np.float32),
+                  "flips": np.array(exam["view"].flips)}
+        for i, packed in enumerate(masks.values()):
+            arrays[f"mask_{i}"] = packed
+        if image is not None:
+            arrays["image"] = np.asarray(image, dtype=np.int16)
+        os.makedirs(path.parent, exist_ok=True)
+        # Written next to the old file and renamed over it, so a failed save keeps the previous annotations
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, path)
+        npz = {"file": path.name, "labels": [str(label) for label in masks], "shape": [int(i) for i in shape]}
+        annotation_manifest(save_directory).update(exam["study_id"], {"npz": npz})
+        if progress is not None:
+            progress(100)
+
+    def read(self, save_directory, study_id, mask_type, shape, progress=None):
+        path = self.path(save_directory, study_id)
+        if not path.is_file():
+            return None
+        with np.load(path) as data:
+            labels = [str(label) for label in data["labels"]]
+            if mask_type not in labels or tuple(data["shape"]) != tuple(shape):
+                return None
+            mask_stack = MaskVolume(shape, data[f"mask_{labels.index(mask_type)}"])
+        if progress is not None:
+            progress(100)
+        return mask_stack
+
+
+annotation_writers = {"npz": NPZAnnotationWriter(), "png": PNGAnnotationWriter()}
+
+
+def read_study_masks(save_directory, study_id, mask_type, shape, progress=None, save_format="npz"):
+
+    # The format being saved in is looked up first, so an older save in the other format is not picked up.
+    # Masks read from the other format keep every slice dirty, as none of them are saved in the current format
+    formats = [save_format] + [name for name in annotation_writers if name != save_format]
+    for name in formats:
+        mask_stack = annotation_writers[name].read(save_directory, study_id, mask_type, shape, progress)
+        if mask_stack is not None:
+            if name == save_format:
+                mask_stack.markSaved()
+            return mask_stack
+    return None
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from pathlib import Path
+
+
+class VolumeCache:
+
+    """ On-disk cache of decoded HU volumes.
+
+        Every entry is a directory named after the series' study/series UIDs and file mtimes, holding the
+        volume as a .npy file (opened memory-mapped) and the scanned series information as json.
+        Folders are mapped to their entry through a signature of the file paths, mtimes and sizes,
+        so a cached exam is found with os.stat calls only. Least recently used entries are removed
+        when the cache grows over max_bytes.
+    """
+
+    def __init__(self, cache_directory, max_bytes):
+        self.cache_directory = Path(cache_directory)
+        self.max_bytes = max_bytes
+
+    def signature(self, dicom_paths, use_file_order=False):
+        h = hashlib.sha1(f"{use_file_order}\n".encode())
+        for path in dicom_paths:
+            stat = os.stat(path)
+            h.update(f"{path}|{stat.st_mtime_ns}|{stat.st_size}\n".encode())
+        return h.hexdigest()
+
+    def entryName(self, series):
+        h = hashlib.sha1(f"{series['study_uid']}|{series['series_uid']}\n".encode())
+        for path, mtime in zip(series["paths"], series["mtimes"]):
+            h.update(f"{Path(path).name}|{mtime}\n".encode())
+        return h.hexdigest()
+
+    def load(self, signature):
+        try:
+            name = (self.cache_directory / "signatures" / signature).read_text().strip()
+            entry = self.cache_directory / "volumes" / name
+            with open(entry / "series.json") as f:
+                series = json.load(f)
+            stack = np.load(entry / "volume.npy", mmap_mode="r")
+        except (OSError, ValueError):
+            return None, None
+        series["paths"] = [Path(path) for path in series["paths"]]
+        series["shape"] = tuple(series["shape"])
+        if stack.shape != series["shape"] or stack.dtype != np.int16:
+            return None, None
+        os.utime(entry / "series.json")
+        return stack, series
+
+    def reserve(self):
+        try:
+            volumes = self.cache_directory / "volumes"
+            os.makedirs(volumes, exist_ok=True)
+            return Path(tempfile.mkdtemp(prefix=".tmp", dir=volumes))
+        except OSError:
+            return None
+
+    def release(self, tmp):
+        # A reserved directory that is not committed, e.g. of an exam left before it was fully decoded
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def commit(self, signature, series, tmp):
+        # The volume is written to a temporary directory first so a partially written entry is never found
+        name = self.entryName(series)
+        entry = self.cache_directory / "volumes" / name
+        signatures = self.cache_directory / "signatures"
+        try:
+            os.makedirs(signatures, exist_ok=True)
+            if entry.is_dir():
+                shutil.rmtree(tmp, ignore_errors=True)
+            else:
+                with open(tmp / "series.json", "w") as f:
+                    json.dump(dict(series, paths=[str(path) for path in series["paths"]]), f, default=str)
+                os.rename(tmp, entry)
+            pointer = signatures / (signature + ".tmp")
+            pointer.write_text(name)
+            os.replace(pointer, signatures / signature)
+            self.evict(keep=name)
+        except OSError:
+            return None
+        return entry / "volume.npy"
+
+    def store(self, signature, series, stack):
+        tmp = self.reserve()
+        if tmp is None:
+            return stack
+        try:
+            np.save(tmp / "volume.npy", np.ascontiguousarray(stack, dtype=np.int16))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return stack
+        path = self.commit(signature, series, tmp)
+        if path is None:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return stack
+        return np.load(path, mmap_mode="r")
+
+    def entries(self):
+        volumes = self.cache_directory / "volumes"
+        if not volumes.is_dir():
+            return []
+        entries = []
+        for entry in volumes.iterdir():
+            if entry.name.startswith(".tmp") and time.time() - os.stat(entry).st_mtime > 24 * 60 * 60:
+                shutil.rmtree(entry, ignore_errors=True)
+            if entry.name.startswith(".tmp") or not entry.is_dir():
+                continue
+            try:
+                last_access = os.stat(entry / "series.json").st_mtime
+                size = sum(os.stat(path).st_size for path in entry.iterdir())
+            except OSError:
+                continue
+            entries.append((last_access, size, entry))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry.name == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            if not entry.exists():
+                total -= size
+        signatures = self.cache_directory / "signatures"
+        if signatures.is_dir():
+            for pointer in signatures.iterdir():
+                try:
+                    if not (self.cache_directory / "volumes" / pointer.read_text().strip()).is_dir():
+                        pointer.unlink()
+                except OSError:
+                    pass
+
+    def setMaxBytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
@@ -1,5 +1,5 @@
 from PyQt6.QtWidgets import QGraphicsScene, QApplication, QPushButton, QLineEdit, QVBoxLayout, QFormLayout, QDialog, QGridLayout, QDialogButtonBox, QTableWidget, QHeaderView, QMenu, QAbstractItemView, QSizePolicy, QStyle, QStyleOptionSlider, QSlider
-from PyQt6.QtGui import QIntValidator, QAction, QCursor, QPen, QBrush, QPainter, QPalette, QColor
+from PyQt6.QtGui import QIntValidator, QAction, QCursor, QPen, QBrush, QPainter, QPalette, QColor, QImage, QPixmap
 from PyQt6.QtCore import Qt, QRect, QPoint, pyqtSignal
 
 from gui_utils.drawing_utils import *
@@ -25,9 +25,88 @@ class CTGraphicsScene(QGraphicsScene):
         self.adjustX = None
         self.adjustY = None
         self.measureLine = None
+        self.stroke = None
+        self.strokeRect = None
+        self.imageItem = None
+        self.overlayItem = None
+        self.overlay = None
+
+    def clear(self):
+        super().clear()
+        self.imageItem = None
+        self.overlayItem = None
+        self.overlay = None
+        self.measureLine = None
+
+    def setImage(self, pixmap):
+        if self.imageItem is None:
+            self.imageItem = self.addPixmap(pixmap)
+        else:
+            self.imageItem.setPixmap(pixmap)
+
+    def setOverlay(self, overlay):
+        # The RGBA overlay array is kept so that painting can update a rectangle of it, an empty overlay
+        # only hides the item
+        self.overlay = overlay
+        if not overlay[:, :, 3].any():
+            if self.overlayItem is not None:
+                self.overlayItem.hide()
+            return
+        h, w, c = overlay.shape
+        pixmap = QPixmap.fromImage(QImage(overlay.data, w, h, c * w, QImage.Format.Format_RGBA8888))
+        if self.overlayItem is None:
+            self.overlayItem = self.addPixmap(pixmap)
+            self.overlayItem.setZValue(1)
+        else:
+            self.overlayItem.setPixmap(pixmap)
+            self.overlayItem.show()
+
+    def updateOverlay(self, top, bottom, left, right):
+        # Only the rectangle is uploaded, the item releases its pixmap first so painting into it does not copy it
+        if self.overlayItem is None or not self.overlayItem.isVisible():
+            self.setOverlay(self.overlay)
+            return
+        pixmap = self.overlayItem.pixmap()
+        self.overlayItem.setPixmap(QPixmap())
+        h, w, c = self.overlay.shape
+        image = QImage(self.overlay.data, w, h, c * w, QImage.Format.Format_RGBA8888)
+        rect = QRect(left, top, right - left, bottom - top)
+        p = QPainter(pixmap)
+        p.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+        p.drawImage(rect, image, rect)
+        p.end()
+        self.overlayItem.setPixmap(pixmap)
 
     def createMask(self, maskType):
-        self.mask[maskType] = np.zeros(self.parent.currentDICOMStack.shape)
+        # Only one label is drawn at a time, so every label shares the same slice sized stroke buffer
+        shape = self.parent.currentDICOMStack.shape[1:]
+        if self.stroke is None or self.stroke.shape != shape:
+            self.stroke = np.zeros(shape, dtype=np.uint8)
+            self.strokeRect = None
+        self.mask[maskType] = self.stroke
+
+    def paintStroke(self, x, y):
+        top, bottom = y - self.drawingLow, y + self.drawingHigh
+        left, right = x - self.drawingLow, x + self.drawingHigh
+        try:
+            self.stroke[top:bottom, left:right] = self.drawingShape
+        except ValueError:
+            return
+        if self.strokeRect is None:
+            self.strokeRect = [top, bottom, left, right]
+        else:
+            self.strokeRect = [min(self.strokeRect[0], top), max(self.strokeRect[1], bottom),
+                               min(self.strokeRect[2], left), max(self.strokeRect[3], right)]
+
+    def takeStroke(self):
+        # Returns the painted rectangle and a copy of its stroke, and clears it from the buffer
+        if self.strokeRect is None:
+            return None, None
+        top, bottom, left, right = self.strokeRect
+        stroke = self.stroke[top:bottom, left:right].copy()
+        self.stroke[top:bottom, left:right] = 0
+        self.strokeRect = None
+        return (top, bottom, left, right), stroke
 
     def keyPressEvent(self, event):
         if not self.drawing:
@@ -70,10 +149,7 @@ class CTGraphicsScene(QGraphicsScene):
                 if (self.parent.clickType["Drawing"] or self.parent.clickType["Erasing"]) and self.imageType == "axial" and self.drawnMaskType is not None and self.maskShown and self.parent.currentMaskStack[self.drawnMaskType] is not None and self.parent.showMasks and self.imageType == "axial" and self.mask[self.drawnMaskType] is not None and x >= 0 and y >= 0 and x < self.parent.currentDICOMStack.shape[2] and y < self.parent.currentDICOMStack.shape[1] and not self.adjusting:
                     self.drawing = True
                     self.currentMaskIndex = self.parent.axialDICOMIndex
-                    try:
-                        self.mask[self.drawnMaskType][self.currentMaskIndex, y - self.drawingLow:y + self.drawingHigh, x - self.drawingLow:x + self.drawingHigh] = self.drawingShape
-                    except ValueError:
-                        pass
+                    self.paintStroke(x, y)
                     self.parent.drawMask()
                 elif self.parent.clickType["Selecting"]:
                     if x < 0 or y < 0:
@@ -120,10 +196,7 @@ class CTGraphicsScene(QGraphicsScene):
         y = int(event.scenePos().y())
         if self.parent.currentDICOMStack is not None:
             if self.drawing and x >= 0 and y >= 0 and x < self.parent.currentDICOMStack.shape[2] and y < self.parent.currentDICOMStack.shape[1]:
-                try:
-                    self.mask[self.drawnMaskType][self.currentMaskIndex, y - self.drawingLow:y + self.drawingHigh, x - self.drawingLow:x + self.drawingHigh] = self.drawingShape
-                except ValueError:
-                    pass
+                self.paintStroke(x, y)
                 self.parent.drawMask()
             elif self.adjusting and x >= 0 and y >= 0 and x < self.parent.currentDICOMStack.shape[2] and y < self.parent.currentDICOMStack.shape[1] and self.adjustX is not None and self.adjustY is not None:
                 xChange = x - self.adjustX
@@ -132,10 +205,11 @@ class CTGraphicsScene(QGraphicsScene):
                     self.parent.brightness += xChange * 1
                 if self.parent.contrast > 0 or (self.parent.contrast <= 0 < yChange):
                     self.parent.contrast += yChange * 0.0001
+                self.parent.renderScheduler.schedule("axial")
             elif self.measuring and x >= 0 and y >= 0 and x < self.parent.currentDICOMStack.shape[2] and y < self.parent.currentDICOMStack.shape[1] and self.adjustX is not None and self.adjustY is not None:
                 xChange = abs(x - self.adjustX)
                 yChange = abs(self.adjustY - y)
-                currentDICOMIndex = self.parent.axialDICOMIndex
+                currentDICOMIndex = self.parent.volumeView.source(0, self.parent.axialDICOMIndex)
                 pixelSpacingX = self.parent.pixelSpacingX[str(currentDICOMIndex)]
                 pixelSpacingY = self.parent.pixelSpacingY[str(currentDICOMIndex)]
                 mmChangeX = xChange * pixelSpacingX
@@ -146,6 +220,7 @@ class CTGraphicsScene(QGraphicsScene):
                     measurePen = QPen()
                     measurePen.setColor(QColor(32, 128, 64))
                     self.measureLine = self.addLine(x, y, self.adjustX, self.adjustY, pen=measurePen)
+                    self.measureLine.setZValue(2)
                 else:
                     self.measureLine.setLine(x, y, self.adjustX, self.adjustY)
 
@@ -605,6 +680,35 @@ class SelectExamDialog(QDialog):
         self.accept()
 
 
+class CacheSizeDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        layout = QVBoxLayout()
+        self.formLayout = QFormLayout()
+        onlyInt = QIntValidator()
+        self.setSizeValue = QLineEdit()
+        self.setSizeValue.setValidator(onlyInt)
+        self.setSizeValue.setText(str(parent.volumeCacheSize))
+        self.formLayout.addRow("Cache size (GB): ", self.setSizeValue)
+        buttons = QDialogButtonBox()
+        buttons.setStandardButtons(
+            QDialogButtonBox.StandardButton.Cancel
+            | QDialogButtonBox.StandardButton.Ok
+        )
+        layout.addLayout(self.formLayout)
+        layout.addWidget(buttons)
+        self.setWindowTitle("Set exam cache size")
+        self.setLayout(layout)
+        buttons.accepted.connect(self.accepting)
+        buttons.rejected.connect(self.rejecting)
+
+    def rejecting(self):
+        self.reject()
+
+    def accepting(self):
+        self.accept()
+
+
 class NameLabelsDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -0,0 +1,255 @@
+import os
+import tempfile
+import threading
+import numpy as np
+import pydicom.errors
+
+from concurrent.futures import CancelledError, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from pydicom import dcmread
+from pathlib import Path
+
+from PyQt6.QtCore import QObject, QCoreApplication, QEventLoop, pyqtSignal
+
+from gui_utils.image_utils import read_hu_image
+
+
+def read_dicom_header(dicom_path):
+
+    ds = dcmread(dicom_path, stop_before_pixels=True)
+    if "Rows" not in ds or "Columns" not in ds:
+        raise pydicom.errors.InvalidDicomError(f"{dicom_path} does not contain an image")
+    try:
+        instance_number = int(ds.InstanceNumber)
+    except (AttributeError, TypeError, ValueError):
+        instance_number = None
+    try:
+        position = float(ds.ImagePositionPatient[2])
+    except (AttributeError, IndexError, TypeError, ValueError):
+        position = None
+    try:
+        spacing_x = float(ds.PixelSpacing[0])
+        spacing_y = float(ds.PixelSpacing[1])
+    except (AttributeError, IndexError, TypeError, ValueError):
+        spacing_x = 1.0
+        spacing_y = 1.0
+    return {"instance_number": instance_number,
+            "position": position,
+            "rows": int(ds.Rows),
+            "columns": int(ds.Columns),
+            "spacing_x": spacing_x,
+            "spacing_y": spacing_y,
+            "study_id": ds.get("StudyID", 0),
+            "patient_id": ds.get("PatientID", None),
+            "study_uid": str(ds.get("StudyInstanceUID", "")),
+            "series_uid": str(ds.get("SeriesInstanceUID", "")),
+            "invert": ds.get("PhotometricInterpretation", "") == "MONOCHROME1",
+            "mtime": os.stat(dicom_path).st_mtime_ns}
+
+
+def slice_order(headers, use_file_order=False):
+
+    # InstanceNumber first, then descending table position (head to feet), then filename
+    order = list(range(len(headers)))
+    if not use_file_order:
+        order.sort(key=lambda i: (headers[i]["instance_number"] is None,
+                                  headers[i]["instance_number"] or 0,
+                                  -(headers[i]["position"] or 0.0),
+                                  i))
+    return order
+
+
+def read_dicom_slice(dicom_path):
+
+    ds = dcmread(dicom_path)
+    return read_hu_image(ds)
+
+
+def find_dicoms(folder_path):
+
+    dicoms = sorted(Path(folder_path).rglob("*.dcm"))
+    if len(dicoms) == 0:
+        dicoms = sorted(Path(folder_path).rglob("*"))
+    return dicoms
+
+
+def scan_series(dicom_paths, use_file_order=False, executor=None):
+
+    # Only the headers are read here, so invalid folders are rejected before any pixel data is decoded
+    if executor is None:
+        headers = [read_dicom_header(path) for path in dicom_paths]
+    else:
+        headers = list(executor.map(read_dicom_header, dicom_paths))
+    if len({(header["rows"], header["columns"]) for header in headers}) > 1:
+        raise ValueError("DICOMs have different shapes")
+    order = slice_order(headers, use_file_order)
+    first = headers[order[0]]
+    series = {"paths": [dicom_paths[i] for i in order],
+              "shape": (len(headers), first["rows"], first["columns"]),
+              "spacing_x": {str(index): headers[i]["spacing_x"] for index, i in enumerate(order)},
+              "spacing_y": {str(index): headers[i]["spacing_y"] for index, i in enumerate(order)},
+              "mtimes": [headers[i]["mtime"] for i in order],
+              "study_id": first["study_id"],
+              "patient_id": first["patient_id"],
+              "study_uid": first["study_uid"],
+              "series_uid": first["series_uid"],
+              "invert": first["invert"]}
+    return series
+
+
+def decode_series(series, executor=None, callback=None, out=None, indexes=None, decoded=None, pending=None):
+
+    # Slices are decoded to HU and written into the preallocated int16 stack as they complete and are
+    # flagged in decoded if given, decoding stops and None is returned if the callback returns False.
+    # The futures of the submitted slices are kept in pending if given, by slice index
+    stack = np.zeros(series["shape"], dtype=np.int16) if out is None else out
+    if indexes is None:
+        indexes = range(len(series["paths"]))
+    if executor is None:
+        for done, i in enumerate(indexes, start=1):
+            stack[i, :, :] = read_dicom_slice(series["paths"][i])
+            if decoded is not None:
+                decoded[i] = True
+            if callback is not None and callback(done, len(indexes)) is False:
+                return None
+        return stack
+    futures = {executor.submit(read_dicom_slice, series["paths"][i]): i for i in indexes}
+    if pending is not None:
+        pending.update({i: future for future, i in futures.items()})
+    try:
+        for done, future in enumerate(as_completed(futures), start=1):
+            stack[futures[future], :, :] = future.result()
+            if decoded is not None:
+                decoded[futures[future]] = True
+            if callback is not None and callback(done, len(futures)) is False:
+                raise InterruptedError
+    except InterruptedError:
+        for future in futures:
+            future.cancel()
+        return None
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return stack
+
+
+class LazyVolume:
+
+    """ HU volume backed by a memory-mapped file.
+
+        Axial slices are decoded when they are first accessed, coronal and sagittal slices and
+        whole-volume access decode every missing slice first. The file is a temporary file or,
+        when given a path, a .npy file that can be kept after all slices are decoded.
+    """
+
+    def __init__(self, series, path=None, executor=None, callback=None, on_complete=None):
+        self.series = series
+        self.shape = tuple(series["shape"])
+        self.dtype = np.dtype(np.int16)
+        self.ndim = 3
+        self.executor = executor
+        self.callback = callback
+        self.on_complete = on_complete
+        if path is None:
+            self._data = np.memmap(tempfile.TemporaryFile(), dtype=np.int16, mode="w+", shape=self.shape)
+        else:
+            self._data = np.lib.format.open_memmap(path, mode="w+", dtype=np.int16, shape=self.shape)
+        self._decoded = np.zeros(self.shape[0], dtype=bool)
+        self._pending = None
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self[i]
+
+    def __getitem__(self, key):
+        axial = key[0] if isinstance(key, tuple) else key
+        self.ensure(np.arange(self.shape[0])[axial])
+        return self._data[key]
+
+    def __array__(self, dtype=None, copy=None):
+        self.ensure(range(self.shape[0]))
+        return np.asarray(self._data, dtype=dtype)
+
+    def complete(self):
+        return bool(self._decoded.all())
+
+    def ensure(self, indexes):
+        with self._lock:
+            missing = [int(i) for i in np.atleast_1d(indexes) if not self._decoded[i]]
+            if not missing:
+                return
+            if self._pending is not None:
+                # Re-entered from the progress callback of a running decode (e.g. a view rendered while it
+                # processes events), the slices it already submitted are waited for instead of decoded again
+                # and on_complete is left to the running decode
+                for i in missing:
+                    future = self._pending.get(i)
+                    try:
+                        self._data[i] = read_dicom_slice(self.series["paths"][i]) if future is None else future.result()
+                    except CancelledError:
+                        self._data[i] = read_dicom_slice(self.series["paths"][i])
+                    self._decoded[i] = True
+                return
+            callback = self.callback if len(missing) > 1 else None
+            self._pending = {}
+            try:
+                if decode_series(self.series, self.executor, callback, self._data, missing, self._decoded, self._pending) is None:
+                    return
+            finally:
+                self._pending = None
+            if self._decoded.all():
+                self._data.flush()
+                if self.on_complete is not None:
+                    self.on_complete(self)
+
+
+class DICOMLoader(QObject):
+
+    progress = pyqtSignal(int)
+
+    def __init__(self, workers=None, use_processes=False, parent=None):
+        super().__init__(parent)
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.use_processes = use_processes
+        self._executor = None
+
+    def executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="dicom-loader")
+        return self._executor
+
+    def setUseProcesses(self, use_processes):
+        if use_processes != self.use_processes:
+            self.shutdown()
+            self.use_processes = use_processes
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def scan(self, dicom_paths, use_file_order=False):
+        return scan_series(dicom_paths, use_file_order, self.executor())
+
+    def progressCallback(self, done, total):
+
+        # The calling thread only keeps the progress bar painted while the pool decodes
+        self.progress.emit(int(done * (100 / total)))
+        QCoreApplication.processEvents(QEventLoop.ProcessEventsFlag.ExcludeUserInputEvents)
+
+    def load(self, series):
+        return decode_series(series, self.executor(), self.progressCallback)
+
+    def loadLazy(self, series, path=None, on_complete=None):
+        return LazyVolume(series, path, self.executor(), self.progressCallback, on_complete)
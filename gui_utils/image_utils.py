@@ -1,11 +1,13 @@
 import numpy as np
 
-from pydicom.pixel_data_handlers.util import apply_voi_lut, apply_modality_lut
+from pydicom.pixel_data_handlers.util import apply_modality_lut
 
 from skimage.morphology import remove_small_objects
 from skimage.measure import label
 from skimage.measure import regionprops
 
+from gui_utils.mask_utils import MaskVolume
+
 
 def reset_mask_stack(current_labels):
 
@@ -15,30 +17,48 @@ def reset_mask_stack(current_labels):
     return new_labels
 
 
-def adjust_image(ds, window_center, window_width):
+def read_hu_image(ds):
+
+    arr = ds.pixel_array
+    hu = apply_modality_lut(arr, ds)  # apply rescale slope/intercept or modality LUT
+    hu = hu.reshape((ds.Rows, ds.Columns))
+    hu = np.clip(np.rint(hu), -32768, 32767).astype(np.int16)
+    return hu
+
+
+def window_lut(window_center, window_width, invert=False):
+
+    # Linear VOI windowing (DICOM PS3.3 C.11.2.1.2) scaled to the full uint16 range, as a table
+    # indexed by the int16 HU values reinterpreted as uint16
+    hu = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.float32)
+    low = window_center - 0.5 - (window_width - 1) / 2
+    scale = 65535 / max(window_width - 1, 1)
+    lut = (hu - np.float32(low)) * np.float32(scale)
+    np.clip(lut, 0, 65535, out=lut)
+    lut = lut.astype(np.uint16)
+    if invert:  # MONOCHROME1 ranges from bright to dark with ascending pixel values
+        lut = 65535 - lut
+    return lut
+
+
+def adjust_lut(lut, brightness, contrast):
+
+    # Contrast as a 16.16 fixed point factor keeps the whole table in integer arithmetic
+    scale = int(round(contrast * 65536))
+    adjusted = (lut.astype(np.int64) * scale >> 16) + int(brightness)
+    np.clip(adjusted, 0, 65535, out=adjusted)
+    return adjusted.astype(np.uint16)
+
+
+def apply_lut(hu_image, lut):
 
-    arr = ds.pixel_array.copy()
-    ds.WindowCenter = window_center
-    ds.WindowWidth = window_width
-    voi_out = apply_modality_lut(arr, ds)
-    voi_out = apply_voi_lut(voi_out, ds)  # apply VOI LUT or windowing operation
-    out = voi_out
-    bitdepth = ds.BitsAllocated
-    if ds.PhotometricInterpretation == 'MONOCHROME1':  # ranges from bright to dark with ascending pixel values
-        out = out.max() - out
-    out = out.reshape((ds.Rows, ds.Columns))
-    out = out.astype(np.float64)
-    out += -out.min()  # NOTE: converting to uint16 with negative values ruins the image
-    if out.max() > 0:
-        out /= out.max()
-    out *= pow(2, bitdepth) - 1
-    out = out.astype(np.uint16)
-    return out
+    return lut[hu_image.view(np.uint16)]
 
 
 def remove_outliers(mask_stack):
 
-    mask_stack = mask_stack > 0
+    packed = isinstance(mask_stack, MaskVolume)
+    mask_stack = np.asarray(mask_stack) > 0
     labels = label(mask_stack)
     regions = regionprops(labels)
     if len(regions) > 0:
@@ -49,4 +69,6 @@ def remove_outliers(mask_stack):
     if mask_stack.dtype == bool:
         mask_stack = mask_stack.astype("uint8")
         mask_stack *= 255
+    if packed:
+        return MaskVolume.fromArray(mask_stack)
     return mask_stack
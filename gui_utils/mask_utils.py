@@ -0,0 +1,177 @@
+import operator
+import itertools
+import numpy as np
+
+
+_versions = itertools.count()
+
+
+class MaskVolume:
+
+    """ Binary mask volume stored bit-packed along the last axis.
+
+        Slices are unpacked on access and returned as uint8 arrays holding 0 and 255, any value above
+        zero that is written is stored as set. A 512x512x600 label takes about 20 MB instead of 1.2 GB.
+        The version changes on every write and is unique across volumes, so renders can be keyed by it.
+        Axial slices written since the last save are kept in dirty, a new volume has every slice dirty.
+        Snapshots share the packed bits with the volume until it is written next.
+    """
+
+    def __init__(self, shape, packed=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = 3
+        if packed is None:
+            packed = np.zeros((self.shape[0], self.shape[1], (self.shape[2] + 7) // 8), dtype=np.uint8)
+        self.packed = packed
+        self.version = next(_versions)
+        self.dirty = set(range(self.shape[0]))
+        self._shared = False
+
+    @classmethod
+    def fromArray(cls, array):
+        if isinstance(array, MaskVolume):
+            return array.copy()
+        volume = cls(array.shape)
+        for i in range(array.shape[0]):
+            volume.packed[i] = np.packbits(np.asarray(array[i]) > 0, axis=-1)
+        return volume
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self.axial(i)
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.unpackbits(self.packed, axis=-1, count=self.shape[2])
+        array *= 255
+        return array if dtype is None else array.astype(dtype)
+
+    def axial(self, index, top=0, bottom=None, left=0, right=None):
+        # A rectangle of the slice only unpacks the bytes it covers
+        right = self.shape[2] if right is None else right
+        first = left // 8
+        plane = np.unpackbits(self.packed[index, top:bottom, first:(right + 7) // 8], axis=-1)
+        plane = plane[:, left - first * 8:right - first * 8]
+        plane *= 255
+        return plane
+
+    def coronal(self, index):
+        plane = np.unpackbits(self.packed[:, index, :], axis=-1, count=self.shape[2])
+        plane *= 255
+        return plane
+
+    def sagittal(self, index):
+        index = operator.index(index)
+        if not -self.shape[2] <= index < self.shape[2]:
+            raise IndexError(f"index {index} is out of bounds for axis 2 with size {self.shape[2]}")
+        index %= self.shape[2]
+        plane = (self.packed[:, :, index // 8] >> (7 - index % 8)) & 1
+        plane *= 255
+        return plane
+
+    def _detach(self):
+        if self._shared:
+            self.packed = self.packed.copy()
+            self._shared = False
+
+    def setAxial(self, index, plane):
+        self._detach()
+        self.packed[index] = np.packbits(np.asarray(plane) > 0, axis=-1)
+        self.version = next(_versions)
+        self.dirty.add(int(index) % self.shape[0])
+
+    def paint(self, index, y, x, stroke, value):
+        # Sets (or clears) the pixels of an axial slice under a 2D stroke placed at (y, x), repacking only
+        # the bytes the stroke covers
+        self._detach()
+        h, w = stroke.shape
+        first, last = x // 8, (x + w + 7) // 8
+        block = np.unpackbits(self.packed[index, y:y + h, first:last], axis=-1)
+        block[:, x - first * 8:x - first * 8 + w][stroke > 0] = 1 if value else 0
+        self.packed[index, y:y + h, first:last] = np.packbits(block, axis=-1)
+        self.version = next(_versions)
+        self.dirty.add(int(index) % self.shape[0])
+
+    def _key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (4 - len(key)) + key[i + 1:]
+        return key + (slice(None),) * (3 - len(key))
+
+    def __getitem__(self, key):
+        key = self._key(key)
+        if len(key) == 3:
+            if isinstance(key[0], (int, np.integer)):
+                return self.axial(key[0])[key[1], key[2]]
+            if isinstance(key[1], (int, np.integer)):
+                return self.coronal(key[1])[key[0], key[2]]
+            if isinstance(key[2], (int, np.integer)):
+                return self.sagittal(key[2])[key[0], key[1]]
+        return np.asarray(self)[key]
+
+    def __setitem__(self, key, value):
+        key = self._key(key)
+        if len(key) == 3 and isinstance(key[0], (int, np.integer)):
+            plane = self.axial(key[0])
+            plane[key[1], key[2]] = value
+            self.setAxial(key[0], plane)
+        else:
+            array = np.asarray(self)
+            array[key] = value
+            self.packed = MaskVolume.fromArray(array).packed
+            self._shared = False
+            self.version = next(_versions)
+            self.dirty.update(range(self.shape[0]))
+
+    def markSaved(self, indexes=None):
+        if indexes is None:
+            self.dirty.clear()
+        else:
+            self.dirty.difference_update(indexes)
+
+    def snapshot(self):
+        # Read-only copy for saving in the background, the bits are only copied when this volume is written
+        self._shared = True
+        volume = MaskVolume(self.shape, self.packed)
+        volume.dirty = set(self.dirty)
+        return volume
+
+    def copy(self):
+        volume = MaskVolume(self.shape, self.packed.copy())
+        volume.dirty = set(self.dirty)
+        return volume
+
+    def any(self):
+        return bool(self.packed.any())
+
+    def max(self):
+        return 255 if self.packed.any() else 0
+
+
+def overlay_lut(colors, opacity):
+
+    # Row 0 is transparent background, row i the RGBA color of the i-th label
+    lut = np.zeros((len(colors) + 1, 4), dtype=np.uint8)
+    if len(colors) > 0:
+        lut[1:, :3] = colors
+        lut[1:, 3] = opacity
+    return lut
+
+
+def compose_overlay(masks, lut, shape):
+
+    # Labels are merged into one label index map (later labels drawn over earlier ones), which is turned into
+    # RGBA with a single lookup
+    labels = np.zeros(shape, dtype=np.uint8 if len(lut) <= 256 else np.uint16)
+    for i, mask in enumerate(masks, start=1):
+        np.copyto(labels, i, where=mask > 0)
+    return lut[labels]
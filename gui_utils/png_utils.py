@@ -0,0 +1,104 @@
+import os
+import cv2
+import zlib
+import threading
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+def temporary_path(path):
+
+    return str(path) + ".tmp"
+
+
+def encode_png(path, image, compression=1):
+
+    # Written to a temporary file next to the target, which the caller renames over it,
+    # returns the temporary file and the CRC32 of its contents
+    if callable(image):
+        image = image()
+    ok, buffer = cv2.imencode(".png", np.ascontiguousarray(image), [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    if not ok:
+        raise OSError(f"Could not encode {path}")
+    tmp = temporary_path(path)
+    buffer.tofile(tmp)
+    return tmp, zlib.crc32(buffer)
+
+
+def decode_png(path):
+
+    image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise OSError(f"Could not read {path}")
+    return image
+
+
+class SliceIO:
+
+    """ Encodes and decodes PNG slices in a thread pool, OpenCV releases the GIL while coding.
+
+        At most max_in_flight slices are queued or held at once, results are handed out in order as they
+        complete so the caller can store them right away. Images to write can be given as callables,
+        which are then also evaluated in the pool.
+    """
+
+    def __init__(self, workers=None, max_in_flight=64):
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.max_in_flight = max_in_flight
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="slice-io")
+            return self._executor
+
+    def _map(self, function, jobs, progress=None):
+        jobs = list(jobs)
+        queued = deque()
+        completed = 0
+        try:
+            for job in jobs:
+                if len(queued) >= self.max_in_flight:
+                    yield queued.popleft().result()
+                    completed += 1
+                    if progress is not None:
+                        progress(completed, len(jobs))
+                queued.append(self.executor().submit(function, *job))
+            while queued:
+                yield queued.popleft().result()
+                completed += 1
+                if progress is not None:
+                    progress(completed, len(jobs))
+        finally:
+            # Slices already being coded are waited for, so nothing is written after an error is raised
+            for future in queued:
+                future.cancel()
+            wait(queued)
+
+    def write(self, jobs, compression=1, progress=None):
+        # jobs are (path, image) pairs, returns (temporary file, path, CRC32) of every written file.
+        # If writing fails the temporary files are removed
+        jobs = list(jobs)
+        try:
+            tmps = list(self._map(lambda path, image: encode_png(path, image, compression), jobs, progress))
+        except BaseException:
+            for path, _ in jobs:
+                try:
+                    os.remove(temporary_path(path))
+                except OSError:
+                    pass
+            raise
+        return [(tmp, path, crc) for (tmp, crc), (path, _) in zip(tmps, jobs)]
+
+    def read(self, paths, progress=None):
+        return self._map(decode_png, [(path,) for path in paths], progress)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,100 @@
+import threading
+import numpy as np
+import pydicom.errors
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from gui_utils.dicom_utils import find_dicoms, scan_series, decode_series
+from gui_utils.annotation_utils import read_study_masks
+
+
+def prefetch_exam(folder, context, volume_cache, max_bytes, cancelled, annotation_saver=None):
+
+    dicoms = find_dicoms(folder)
+    if not dicoms:
+        return None
+    try:
+        stack, series = None, None
+        if context["use_volume_cache"]:
+            signature = volume_cache.signature(dicoms, context["use_file_order"])
+            stack, series = volume_cache.load(signature)
+        if series is None:
+            series = scan_series(dicoms, context["use_file_order"])
+            if np.prod(series["shape"]) * (2 + len(context["labels"]) / 8) > max_bytes:
+                return None
+            stack = decode_series(series, callback=lambda done, total: not cancelled.is_set())
+            if stack is None:
+                return None
+            if context["use_volume_cache"]:
+                stack = volume_cache.store(signature, series, stack)
+        masks = {}
+        if context["save_directory"] is not None:
+            if annotation_saver is not None:
+                annotation_saver.wait(context["save_directory"], Path(folder).name)
+            for label in context["labels"]:
+                if cancelled.is_set():
+                    return None
+                masks[label] = read_study_masks(context["save_directory"], Path(folder).name, label, series["shape"],
+                                                 save_format=context["save_format"])
+    except (pydicom.errors.InvalidDicomError, OSError, ValueError):
+        return None
+    return {"dicoms": dicoms, "series": series, "stack": stack, "masks": masks}
+
+
+class ExamPrefetcher:
+
+    """ Loads the scans and saved masks of neighbouring exams in a background thread.
+
+        Jobs are keyed by folder and remember the context (label names, save folder and loading options)
+        they were started with, a finished job is only handed out if the context still matches. Masks are
+        read after any queued save of the exam has been written.
+    """
+
+    def __init__(self, volume_cache, max_bytes, workers=1, annotation_saver=None):
+        self.volume_cache = volume_cache
+        self.max_bytes = max_bytes
+        self.annotation_saver = annotation_saver
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="exam-prefetch")
+        self._jobs = {}
+
+    def prefetch(self, folders, context):
+        folders = [Path(folder) for folder in folders]
+        for folder in list(self._jobs):
+            if folder not in folders or self._jobs[folder][0] != context:
+                self.discard(folder)
+        budget = self.max_bytes // max(len(folders), 1)
+        for folder in folders:
+            if folder not in self._jobs:
+                cancelled = threading.Event()
+                future = self._executor.submit(prefetch_exam, folder, context, self.volume_cache, budget, cancelled,
+                                               self.annotation_saver)
+                self._jobs[folder] = (context, future, cancelled)
+
+    def take(self, folder, context):
+        job = self._jobs.pop(Path(folder), None)
+        if job is None:
+            return None
+        job_context, future, cancelled = job
+        if job_context != context or not future.done():
+            cancelled.set()
+            future.cancel()
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def discard(self, folder):
+        job = self._jobs.pop(Path(folder), None)
+        if job is not None:
+            job[2].set()
+            job[1].cancel()
+
+    def clear(self):
+        for folder in list(self._jobs):
+            self.discard(folder)
+
+    def shutdown(self):
+        self.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
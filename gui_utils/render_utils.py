@@ -0,0 +1,149 @@
+import time
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QObject, QTimer
+from PyQt6.QtGui import QImage
+
+from gui_utils.image_utils import apply_lut
+from gui_utils.mask_utils import compose_overlay
+
+
+def slice_image(stack, lut, volume_view, image_type, index):
+
+    image = apply_lut(volume_view.plane(stack, image_type, index), lut)
+    h, w = image.shape
+    return QImage(image.data, w, h, w * 2, QImage.Format.Format_Grayscale16).copy()
+
+
+def slice_overlay(masks, lut, volume_view, image_type, index, shape):
+
+    return compose_overlay([volume_view.plane(mask, image_type, index) for mask in masks], lut, shape)
+
+
+class RenderScheduler(QObject):
+
+    """ Coalesces view updates so that each view is rendered at most once per frame.
+
+        Views are only marked as pending when scheduled and rendered with the window's state at the
+        time of the frame, so intermediate slider positions are skipped.
+    """
+
+    def __init__(self, render, frame_interval=16, parent=None):
+        super().__init__(parent)
+        self.render = render
+        self.frame_interval = frame_interval
+        self.pending = []
+        self.last_render = 0.0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    def schedule(self, view):
+        if view not in self.pending:
+            self.pending.append(view)
+        if not self.timer.isActive():
+            elapsed = (time.monotonic() - self.last_render) * 1000
+            self.timer.start(max(0, int(self.frame_interval - elapsed)))
+
+    def discard(self, view):
+        if view in self.pending:
+            self.pending.remove(view)
+        if not self.pending:
+            self.timer.stop()
+
+    def flush(self):
+        self.timer.stop()
+        pending, self.pending = self.pending, []
+        self.last_render = time.monotonic()
+        for view in pending:
+            self.render(view)
+
+
+class PixmapCache:
+
+    """ Least recently used cache of rendered slice pixmaps, bounded by their size in bytes. """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.pixmaps = OrderedDict()
+
+    def get(self, key):
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        if key in self.pixmaps:
+            self.nbytes -= self.size(self.pixmaps.pop(key))
+        self.pixmaps[key] = pixmap
+        self.nbytes += self.size(pixmap)
+        while self.nbytes > self.max_bytes and len(self.pixmaps) > 1:
+            _, evicted = self.pixmaps.popitem(last=False)
+            self.nbytes -= self.size(evicted)
+
+    def __contains__(self, key):
+        return key in self.pixmaps
+
+    def clear(self):
+        self.pixmaps.clear()
+        self.nbytes = 0
+
+    def size(self, pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+class SlicePrerenderer:
+
+    """ Renders slice images and mask overlays ahead of the current slice in a background thread.
+
+        Each call to prerender replaces the work queued for the same group (view), finished results are
+        kept until taken by the GUI thread (which turns images into pixmaps) or until the oldest are dropped.
+    """
+
+    def __init__(self, max_results=64):
+        self.max_results = max_results
+        self.generations = {}
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slice-prerender")
+
+    def prerender(self, group, jobs):
+        with self.lock:
+            generation = self.generations.get(group, 0) + 1
+            self.generations[group] = generation
+        self.executor.submit(self._run, group, generation, jobs)
+
+    def _run(self, group, generation, jobs):
+        for key, render in jobs:
+            if generation != self.generations.get(group):
+                return
+            with self.lock:
+                if key in self.results:
+                    continue
+            result = render()
+            with self.lock:
+                # Work replaced or cancelled while rendering (e.g. another exam opened) is dropped
+                if generation != self.generations.get(group):
+                    return
+                self.results[key] = result
+                while len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
+
+    def take(self, key):
+        with self.lock:
+            return self.results.pop(key, None)
+
+    def cancel(self):
+        with self.lock:
+            for group in self.generations:
+                self.generations[group] += 1
+            self.results.clear()
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,74 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+from gui_utils.image_utils import remove_outliers
+
+
+class AnnotationSaver(QObject):
+
+    """ Writes annotations in a background thread.
+
+        Saves run one at a time in the order they were queued, so a later save of an exam always lands after
+        an earlier one. The exam is expected to hold snapshots of the masks, which are not written again
+        while they are saved. Progress, completion and errors are reported through signals with the study ID.
+    """
+
+    progress = pyqtSignal(str, int)
+    finished = pyqtSignal(str)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="annotation-saver")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def save(self, writer, save_directory, exam, outliers=False):
+        key = (str(Path(save_directory)), exam["study_id"])
+        future = self._executor.submit(self._run, writer, save_directory, exam, outliers)
+        with self._lock:
+            self._jobs[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def _run(self, writer, save_directory, exam, outliers):
+        if outliers:
+            exam = dict(exam, masks={maskType: remove_outliers(mask_stack) for maskType, mask_stack in exam["masks"].items()})
+        writer.write(save_directory, exam, lambda value: self.progress.emit(exam["study_id"], value))
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._jobs.get(key) is future:
+                del self._jobs[key]
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            self.finished.emit(key[1])
+        else:
+            self.failed.emit(key[1], str(error))
+
+    def pending(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def wait(self, save_directory, study_id):
+        # Jobs run in order, so the last queued save of the exam is the only one to wait for
+        if save_directory is None:
+            return
+        with self._lock:
+            future = self._jobs.get((str(Path(save_directory)), study_id))
+        if future is not None:
+            wait([future])
+
+    def flush(self):
+        with self._lock:
+            futures = list(self._jobs.values())
+        wait(futures)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -1,52 +1,205 @@
+import os
 import torch
+import threading
 import numpy as np
 
+from collections import OrderedDict
+
+from PyQt6.QtCore import QThread, pyqtSignal
+
+from gui_utils.image_utils import apply_lut
 from model_utils.decoders import FPNDecoder
 from model_utils.decoders import UNetDecoder
 from model_utils.segmentation import EncoderDecoder
 from model_utils.segmentation.backbones import ResNetBackbone
 
 
-def segmentation(models, stack, device, indexes, class_amount, window):
+def stack_statistics(stack):
+
+    # Mean and standard deviation of the stack scaled by 1/256, accumulated slice by slice in float64
+    # instead of converting the whole stack to floats
+    total, squares = 0.0, 0.0
+    for image in stack:
+        image = image.astype(np.float64)
+        total += image.sum()
+        squares += np.square(image).sum()
+    count = stack.size
+    mean = total / count
+    std = np.sqrt(max(squares / count - mean * mean, 0.0))
+    return mean / 256., std / 256.
+
+
+def auto_batch_size(shape, device, max_batch_size=32, fallback_batch_size=8):
+
+    # Rough size of the activations of one slice in the ResNet encoder-decoders, half of the free device
+    # (or available host) memory is used for them. Where free memory can not be queried (available host
+    # memory is not reported by os.sysconf on Windows and macOS) a fixed batch size is used
+    slice_bytes = shape[1] * shape[2] * 4 * 128
+    try:
+        if torch.device(device).type == "cuda":
+            free, _ = torch.cuda.mem_get_info(device)
+        else:
+            free = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError, RuntimeError, AssertionError):
+        return min(max_batch_size, fallback_batch_size)
+    return int(max(1, min(max_batch_size, free // 2 // slice_bytes)))
+
+
+def segmentation_batches(stack, indexes, batch_size, mean, std, pin_memory=False):
+
+    # Normalized float32 batches of the slices to segment, in pinned memory when copying to the GPU
+    for start in range(0, len(indexes), batch_size):
+        batch = indexes[start:start + batch_size]
+        images = torch.empty((len(batch), 1, stack.shape[1], stack.shape[2]), dtype=torch.float32, pin_memory=pin_memory)
+        for i, index in enumerate(batch):
+            image = stack[index, :, :] / 256.
+            image -= mean
+            image /= std
+            image /= 255
+            images[i, 0].copy_(torch.from_numpy(image))
+        yield batch, images
+
+
+class ModelRegistry:
+
+    """ Segmentation models kept loaded in eval mode on their device between runs.
+
+        Models are keyed by checkpoint path and mtime, architecture, class amount and device, so a changed
+        checkpoint is loaded again. The least recently used models are dropped when their parameters and
+        buffers take more than max_bytes, the most recently used one is always kept.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_name, model_weights, class_amount, device):
+        key = (str(model_weights), os.stat(model_weights).st_mtime_ns, model_name, class_amount, str(device))
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+        model = load_segmentation_model(model_name, model_weights, class_amount, device)
+        size = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+        with self._lock:
+            self._models[key] = (model, size)
+            total = sum(size for _, size in self._models.values())
+            while total > self.max_bytes and len(self._models) > 1:
+                _, (_, evicted) = self._models.popitem(last=False)
+                total -= evicted
+        return model
 
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+def load_segmentation_model(model_name, model_weights, class_amount, device):
+
+    model = init_segmentation_model(model_name, class_amount, device=device)
+    model.load_state_dict(torch.load(model_weights, map_location=device)["model"])
+    model.eval()
+    return model
+
+
+def segment_slices(models, stack, device, indexes, class_amount, batch_size=None, cancelled=None, registry=None):
+
+    # Slices are segmented in batches by every model in turn, a pixel is set when more than half of the
+    # models predict it. Yields the slice indexes and predictions (slices, classes, rows, columns) of
+    # every batch, and stops before the next batch once cancelled returns True. On CUDA the next batch
+    # is copied to the device on a separate stream while the current one is being segmented.
     with torch.no_grad():
-        window.progressBar.show()
-        progress = 0
-        average_preds = torch.zeros((stack.shape[0], class_amount, stack.shape[1], stack.shape[2])).to(device)
-        stack = stack / 256.
-        stack -= stack.mean()
-        stack /= stack.std()
-        stack = stack / 255
+        indexes = sorted(indexes) if len(indexes) != 0 else list(range(stack.shape[0]))
+        if batch_size is None:
+            batch_size = auto_batch_size(stack.shape, device)
+        mean, std = stack_statistics(stack)
+        cuda = torch.device(device).type == "cuda"
+        if cuda and not torch.cuda.is_available():
+            raise AssertionError("Torch not compiled with CUDA enabled")
 
         model_name = str(models[0])
-        model = init_segmentation_model(model_name, class_amount, device=device)
-
-        for model_index, model_weights in enumerate(models):
-            model.load_state_dict(torch.load(model_weights, map_location=device)["model"])
-            model = model.to(device)
-            model.eval()
-            for i in range(stack.shape[0]):
-                if i not in indexes and indexes != []:
-                    progress += 1
-                    continue
-                progress += 1
-                window.progressBar.setValue(int(progress / (len(models)*stack.shape[0])*100))
-                image = stack[i, :, :]
-                image = np.expand_dims(image, axis=(0, 1))
-                image = torch.from_numpy(image).to(device).float()
-                out = model(image)
-                th = 0.3
-                preds = out.gt(th)
-                average_preds[i, :, :, :] += preds[0, :, :, :]
-                
-        tensor_pred = average_preds / len(models)
-        tensor_pred = tensor_pred.gt(0.5)
-        if class_amount == 1:
-            numpy_pred = tensor_pred[:, 0, :, :].cpu().detach().numpy()
+        if registry is not None:
+            loaded = [registry.get(model_name, model_weights, class_amount, device) for model_weights in models]
         else:
-            numpy_pred = tensor_pred.cpu().detach().numpy()
-        torch.cuda.empty_cache()
-        return numpy_pred
+            loaded = [load_segmentation_model(model_name, model_weights, class_amount, device) for model_weights in models]
+
+        copy_stream = torch.cuda.Stream(device) if cuda else None
+        th = 0.3
+
+        def upload(images):
+            if copy_stream is None:
+                return images.to(device), None
+            with torch.cuda.stream(copy_stream):
+                images = images.to(device, non_blocking=True)
+                ready = torch.cuda.Event()
+                ready.record(copy_stream)
+            return images, ready
+
+        try:
+            batches = segmentation_batches(stack, indexes, batch_size, mean, std, pin_memory=cuda)
+            batch, images = next(batches)
+            pending = (batch, *upload(images))
+            while pending is not None:
+                if cancelled is not None and cancelled():
+                    return
+                batch, images, ready = pending
+                if ready is not None:
+                    torch.cuda.current_stream().wait_event(ready)
+                    images.record_stream(torch.cuda.current_stream())
+                following = next(batches, None)
+                pending = None if following is None else (following[0], *upload(following[1]))
+                votes = torch.zeros((len(batch), class_amount, stack.shape[1], stack.shape[2]), dtype=torch.uint8, device=device)
+                for model in loaded:
+                    votes += model(images).gt(th)
+                yield batch, (votes * 2 > len(loaded)).cpu().numpy()
+        finally:
+            del loaded
+            if cuda:
+                torch.cuda.empty_cache()
+
+
+class SegmentationWorker(QThread):
+
+    """ Runs segmentation in its own thread on a windowed copy of the stack, in the orientation of the view.
+
+        The predictions of every finished batch are emitted as (slice indexes, bool array of shape
+        (slices, classes, rows, columns)), both in the orientation of the view. Interrupting the thread
+        stops it after the current batch.
+    """
+
+    batchReady = pyqtSignal(list, object)
+    progress = pyqtSignal(int)
+    failed = pyqtSignal(str)
+
+    def __init__(self, models, stack, lut, view, device, indexes, class_amount, batch_size=None, registry=None, parent=None):
+        super().__init__(parent)
+        self.registry = registry
+        self.models = models
+        self.stack = stack
+        self.lut = lut
+        self.view = view
+        self.device = device
+        self.indexes = indexes
+        self.class_amount = class_amount
+        self.batch_size = batch_size
+
+    def run(self):
+        try:
+            stack = self.view.volume(apply_lut(np.asarray(self.stack), self.lut))
+            total = len(self.indexes) if len(self.indexes) != 0 else stack.shape[0]
+            done = 0
+            for batch, predictions in segment_slices(self.models, stack, self.device, self.indexes, self.class_amount,
+                                                     self.batch_size, self.isInterruptionRequested, self.registry):
+                done += len(batch)
+                self.batchReady.emit(batch, predictions)
+                self.progress.emit(int(done / total * 100))
+        except AssertionError:
+            self.failed.emit("CUDA not found, change device to CPU")
+        except RuntimeError:
+            self.failed.emit("Wrong model type!")
+        except Exception as e:
+            self.failed.emit(f"Segmentation failed: {e}")
 
 
 def init_segmentation_model(model_name, n_classes, device='cuda'):
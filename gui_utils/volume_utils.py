@@ -0,0 +1,44 @@
+class VolumeView:
+
+    """ Orientation of the displayed volume relative to the stored one.
+
+        Volumes and masks stay in the orientation they were read in. Flips are applied when slices are
+        taken, by mapping the slice index and returning reversed views of the 2D plane.
+    """
+
+    axes = {"axial": (0, 1, 2), "coronal": (1, 0, 2), "sagittal": (2, 0, 1)}
+
+    def __init__(self, shape, flips=(False, False, False)):
+        self.shape = tuple(shape)
+        self.flips = tuple(flips)
+
+    def source(self, axis, index):
+        return self.shape[axis] - 1 - index if self.flips[axis] else index
+
+    def orient(self, plane, imageType):
+        # Flipping is its own inverse, so this also turns a displayed plane back into a stored one
+        _, rows, columns = self.axes[imageType]
+        return plane[::-1 if self.flips[rows] else 1, ::-1 if self.flips[columns] else 1]
+
+    def volume(self, volume):
+        # The whole volume in the displayed orientation, as a view
+        return volume[tuple(slice(None, None, -1 if flip else 1) for flip in self.flips)]
+
+    def plane(self, volume, imageType, index):
+        axis = self.axes[imageType][0]
+        index = self.source(axis, index)
+        if axis == 0:
+            plane = volume[index, :, :]
+        elif axis == 1:
+            plane = volume[:, index, :]
+        else:
+            plane = volume[:, :, index]
+        return self.orient(plane, imageType)
+
+    def axialRect(self, index, top, bottom, left, right):
+        # Stored slice index and rectangle of a rectangle on a displayed axial slice
+        if self.flips[1]:
+            top, bottom = self.shape[1] - bottom, self.shape[1] - top
+        if self.flips[2]:
+            left, right = self.shape[2] - right, self.shape[2] - left
+        return self.source(0, index), top, bottom, left, right
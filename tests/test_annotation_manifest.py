@@ -0,0 +1,114 @@
+import os
+import cv2
+import shutil
+import pytest
+import numpy as np
+
+from gui_utils.annotation_utils import PNGAnnotationWriter, annotation_manifest, read_study_masks
+from gui_utils.mask_utils import MaskVolume
+from gui_utils.volume_utils import VolumeView
+
+
+def exam(masks, slices=None):
+
+    shape = next(iter(masks.values())).shape
+    return {"study_id": "EX1",
+            "masks": masks,
+            "colors": {},
+            "spacing": [[1.0, 1.0]] * shape[0],
+            "images": None,
+            "lut": None,
+            "view": VolumeView(shape),
+            "save_flipped": False,
+            "slices": {} if slices is None else slices}
+
+
+def test_partial_save_after_rebuild(tmp_path):
+
+    # A folder saved without a manifest is indexed with unknown slice sizes, saving only the changed slice
+    # afterwards must keep the other slices in the index
+    shape = (4, 16, 24)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[:, 4:8, 6:12] = 255
+    writer = PNGAnnotationWriter()
+    writer.write(tmp_path, exam({"liver": MaskVolume.fromArray(mask)}))
+    shutil.rmtree(tmp_path / "manifest")
+
+    loaded = read_study_masks(tmp_path, "EX1", "liver", shape, save_format="png")
+    assert np.array_equal(np.asarray(loaded), mask)
+    assert annotation_manifest(tmp_path).study("EX1")["png"]["liver"]["shape"] == [4, None, None]
+
+    mask[2] = 0
+    loaded.setAxial(2, mask[2])
+    writer.write(tmp_path, exam({"liver": loaded}, {"liver": set(loaded.dirty)}))
+
+    entry = annotation_manifest(tmp_path).study("EX1")["png"]["liver"]
+    assert entry["shape"] == list(shape)
+    assert sorted(entry["files"]) == ["0", "1", "2", "3"]
+    reloaded = read_study_masks(tmp_path, "EX1", "liver", shape, save_format="png")
+    assert reloaded is not None
+    assert np.array_equal(np.asarray(reloaded), mask)
+
+
+def test_interrupted_save_is_completed(tmp_path, monkeypatch):
+
+    # A save interrupted while renaming its slices into place is completed on the next lookup, so the
+    # study does not keep a mix of old and new slices
+    shape = (4, 16, 24)
+    writer = PNGAnnotationWriter()
+    writer.write(tmp_path, exam({"liver": MaskVolume(shape)}))
+    mask = np.full(shape, 255, dtype=np.uint8)
+
+    replace = os.replace
+    renamed = []
+
+    def interrupted(src, dst):
+        if str(src).endswith(".png.tmp") and len(renamed) == 2:
+            raise KeyboardInterrupt
+        renamed.append(dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        writer.write(tmp_path, exam({"liver": MaskVolume.fromArray(mask)}))
+    monkeypatch.setattr(os, "replace", replace)
+
+    loaded = read_study_masks(tmp_path, "EX1", "liver", shape, save_format="png")
+    assert np.array_equal(np.asarray(loaded), mask)
+    assert not list(tmp_path.rglob("*.tmp")) and not list(tmp_path.rglob("*.pending"))
+
+
+def test_failed_save_removes_temporary_files(tmp_path):
+
+    def failing():
+        raise OSError("No space left on device")
+
+    writer = PNGAnnotationWriter()
+    liver = MaskVolume.fromArray(np.full((4, 16, 24), 255, dtype=np.uint8))
+    liver.axial = lambda index: failing() if index == 3 else MaskVolume.axial(liver, index)
+    with pytest.raises(OSError):
+        writer.write(tmp_path, exam({"liver": liver}))
+    assert not list(tmp_path.rglob("*.tmp"))
+    assert not list((tmp_path / "liver_masks").glob("*.png"))
+
+
+def test_slices_saved_without_manifest_are_found(tmp_path):
+
+    # Slices written by an older version or another annotator into a folder that already has a manifest
+    # are looked up by the study's exact ID and added to the manifest
+    shape = (4, 16, 24)
+    writer = PNGAnnotationWriter()
+    writer.write(tmp_path, exam({"liver": MaskVolume(shape)}))
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[:, 2:6, 3:9] = 255
+    os.makedirs(tmp_path / "spleen_masks")
+    for i in range(shape[0]):
+        cv2.imwrite(str(tmp_path / "spleen_masks" / f"EX1_{i}.png"), mask[i])
+        cv2.imwrite(str(tmp_path / "spleen_masks" / f"EX1_B_{i}.png"), np.zeros(shape[1:], dtype=np.uint8))
+
+    loaded = read_study_masks(tmp_path, "EX1", "spleen", shape, save_format="png")
+    assert loaded is not None
+    assert np.array_equal(np.asarray(loaded), mask)
+    entry = annotation_manifest(tmp_path).study("EX1")["png"]["spleen"]
+    assert sorted(entry["files"].values()) == sorted([f"spleen_masks/EX1_{i}.png", None] for i in range(shape[0]))
+    assert read_study_masks(tmp_path, "EX1_B", "spleen", (4, 16, 20), save_format="png") is None